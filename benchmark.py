@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+'''Benchmarks for the steps of generator.py's build. Run with --help for the list.'''
+from __future__ import division, with_statement, print_function
+from argparse import ArgumentParser, SUPPRESS
+
+import bisect
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from cStringIO import StringIO
+
+import lxml.html
+from lxml import etree
+
+import generator
+from generator import print_header, print_error, print_success
+
+def reference_pages(items_dict):
+    '''Flat names of the reference pages a full build renders.'''
+    return sorted(generator.published_reference_pages(items_dict))
+
+def best_of(repeat, func):
+    '''Run func repeat times, returning its last result and the fastest time it took.'''
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def lxml_round_trip(html):
+    '''How clean_html used to normalize pages: parse the page and serialize it again.'''
+    return lxml.html.tostring(lxml.html.fromstring(html), encoding='ascii')
+
+def bench_clean_html(repeat):
+    '''
+    Compare clean_html with the full lxml round trip it replaced, over every
+    reference page. Also checks that the round trip wouldn't change anything
+    clean_html produces, i.e. that the output is the same.
+    '''
+    print_header('clean_html')
+    items_dict = generator.load_reference_items(generator.reference_dir)
+    env = generator.make_environment(os.path.join(generator.src_dir, 'template'), items_dict)
+    template = env.get_template('reference_item_template.jinja')
+    names = reference_pages(items_dict)
+    def render():
+        # Start convert_hypertext afresh each time, as in a build, so that
+        # nothing it remembers carries over from the last run.
+        env.globals['convert_hypertext'].forget()
+        return [template.render(item=items_dict[name], today='') for name in names]
+
+    rendered, render_time = best_of(repeat, render)
+    cleaned, clean_time = best_of(repeat, lambda: [generator.clean_html(page) for page in rendered])
+    round_tripped, round_trip_time = best_of(repeat, lambda: [lxml_round_trip(page) for page in rendered])
+
+    # The templates don't need the fragments from convert_hypertext
+    # normalized to render, so timing a render without doing so shows what
+    # that costs.
+    clean_fragment = generator.clean_fragment
+    generator.clean_fragment = lambda html: html
+    try:
+        _, bare_render_time = best_of(repeat, render)
+    finally:
+        generator.clean_fragment = clean_fragment
+
+    print('{} pages, best of {}:'.format(len(names), repeat))
+    print('    render (normalizing fragments):  {:8.1f} ms'.format(render_time * 1000))
+    print('    render (raw fragments):          {:8.1f} ms'.format(bare_render_time * 1000))
+    print('    clean_html:                      {:8.1f} ms'.format(clean_time * 1000))
+    print('    lxml round trip:                 {:8.1f} ms'.format(round_trip_time * 1000))
+    old_time = bare_render_time + round_trip_time
+    new_time = render_time + clean_time
+    print('    render + clean, before:          {:8.1f} ms'.format(old_time * 1000))
+    print('    render + clean, now:             {:8.1f} ms ({:.1f}x)'.format(new_time * 1000, old_time / new_time))
+
+    different = [name for name, a, b in zip(names, cleaned, round_tripped) if a != b]
+    if different:
+        print_error('{} page(s) would be changed by a round trip through lxml: {}'.format(
+            len(different), ', '.join(different)))
+        return 1
+    print_success('All pages are unchanged by a round trip through lxml.')
+    return 0
+
+def gzipped_size(data):
+    out = StringIO()
+    with gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as f:
+        f.write(data)
+    return len(out.getvalue())
+
+def search_lookup(entries, prefix, limit=20):
+    '''How reference-search.js finds the entries for a prefix in a shard.'''
+    start = bisect.bisect_left(entries, [prefix])
+    matches = []
+    for entry in entries[start:]:
+        if len(matches) == limit or not entry[0].startswith(prefix):
+            break
+        matches.append(entry)
+    return matches
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def bench_search_index(repeat):
+    '''
+    Measure the reference search index: how long it takes to build, how big
+    its shards are, and how long a lookup takes, both on a freshly loaded
+    shard and on one that's already loaded, over every prefix (up to four
+    characters long) of every name in the reference.
+    '''
+    print_header('search index')
+    items_dict = generator.load_reference_items(generator.reference_dir)
+    env = generator.make_environment(os.path.join(generator.src_dir, 'template'), items_dict)
+    items = [items_dict[name] for name in reference_pages(items_dict)]
+    def build():
+        env.globals['convert_hypertext'].forget()
+        return generator.search_index_shards(items, env.globals['convert_hypertext'])
+    shards, build_time = best_of(repeat, build)
+    data = dict((shard, json.dumps(entries, separators=(',', ':'))) for shard, entries in shards.iteritems())
+
+    sizes = [len(d) for d in data.itervalues()]
+    print('{} entries in {} shards, built in {:.1f} ms'.format(
+        sum(len(entries) for entries in shards.itervalues()), len(shards), build_time * 1000))
+    print('    total size:    {:8.1f} KB ({:.1f} KB gzipped)'.format(
+        sum(sizes) / 1024, sum(gzipped_size(d) for d in data.itervalues()) / 1024))
+    print('    largest shard: {:8.1f} KB ({:.1f} KB gzipped)'.format(
+        max(sizes) / 1024, max(gzipped_size(d) for d in data.itervalues()) / 1024))
+
+    prefixes = sorted(set(entry[0][:length] for entries in shards.itervalues()
+            for entry in entries for length in range(1, 5)))
+    cold = []
+    warm = []
+    for prefix in prefixes:
+        shard = generator.search_shard(prefix)
+        start = time.time()
+        entries = json.loads(data[shard])
+        search_lookup(entries, prefix)
+        cold.append(time.time() - start)
+        for _ in range(repeat):
+            start = time.time()
+            matches = search_lookup(entries, prefix)
+            warm.append(time.time() - start)
+        if not matches:
+            print_error('Nothing found for {!r}'.format(prefix))
+            return 1
+    print('{} prefixes looked up:'.format(len(prefixes)))
+    for label, times in (('loading the shard', cold), ('shard already loaded', warm)):
+        print('    {:<22} median {:7.1f} us, 99th percentile {:7.1f} us'.format(
+            label + ':', percentile(times, 0.5) * 1e6, percentile(times, 0.99) * 1e6))
+    print_success('Every prefix finds its entries.')
+    return 0
+
+def scaled_name(flat_name, copy):
+    return flat_name if copy == 0 else '{}_{}'.format(flat_name, copy)
+
+def make_corpus(scale, corpus_dir):
+    '''
+    Write scale copies of the reference into corpus_dir. Each copy's pages
+    are renamed (rect_1.xml, rect_2.xml, and so on), and its relateds,
+    method refs and <ref>s point at the pages of the same copy, so every
+    copy links up like the real reference does. Returns the number of pages.
+    '''
+    parser = etree.XMLParser(strip_cdata=False)
+    sources = sorted(f for f in os.listdir(generator.reference_dir) if f.endswith('.xml'))
+    flat_names = set(f[:-4] for f in sources)
+    def rename(target, copy):
+        stem = target[:-4] if target.endswith('.xml') else target
+        if stem not in flat_names:
+            return target
+        return scaled_name(stem, copy) + target[len(stem):]
+    if not os.path.exists(corpus_dir):
+        os.makedirs(corpus_dir)
+    for filename in sources:
+        for copy in range(scale):
+            tree = etree.parse(os.path.join(generator.reference_dir, filename), parser)
+            if copy:
+                for element in tree.iter('related', 'ref'):
+                    if element.get('target'):
+                        element.set('target', rename(element.get('target'), copy))
+                    elif element.text:
+                        element.text = rename(element.text.strip(), copy)
+            tree.write(os.path.join(corpus_dir, scaled_name(filename[:-4], copy) + '.xml'),
+                    encoding='UTF-8', xml_declaration=True)
+    return len(sources) * scale
+
+def run_scale(scale, result_path):
+    '''
+    Build the reference of a synthetic corpus scale times the size of the
+    real one, timing each phase, and write the results to result_path as
+    JSON. Runs in a process of its own (see bench_scale), so that peak memory
+    is that of one scale alone.
+    '''
+    work_dir = tempfile.mkdtemp(prefix='processing-py-site-bench')
+    # Everything the build writes goes into work_dir, and so does what it
+    # prints, so as not to drown out the results.
+    generator.target_dir = os.path.join(work_dir, 'generated/')
+    generator.target_reference_dir = generator.target_dir + generator.canon_reference_dir
+    generator.cache_dir = os.path.join(work_dir, 'cache/')
+    stdout = sys.stdout
+    sys.stdout = open(os.path.join(work_dir, 'output.txt'), 'w')
+    try:
+        corpus_dir = os.path.join(work_dir, 'reference')
+        pages = make_corpus(scale, corpus_dir)
+        phases = []
+        def phase(name, count, func):
+            start = time.time()
+            result = func()
+            seconds = time.time() - start
+            phases.append({'name': name, 'count': count, 'seconds': seconds,
+                'per_second': count / seconds if seconds else None, 'peak_rss_kb': (generator.peak_rss() or {}).get('self')})
+            return result
+
+        paths = [os.path.join(corpus_dir, f) for f in sorted(os.listdir(corpus_dir))]
+        items = phase('parse', len(paths), lambda: [generator.ReferenceItem(path) for path in paths])
+        items_dict = dict((item.flatname, item) for item in items)
+        items_dict[''] = items_dict['blank'] # As load_reference_items does
+        env = generator.make_environment(os.path.join(generator.src_dir, 'template'), items_dict)
+        convert_hypertext = env.globals['convert_hypertext']
+        elements = [element for item in items for element in item.hypertext_fragments()]
+        phase('convert_hypertext', len(elements), lambda: [convert_hypertext(element) for element in elements])
+        # The build converts everything afresh.
+        convert_hypertext.forget()
+        to_update = reference_pages(items_dict)
+        generator.build_profile.reset()
+        phase('build_reference', len(to_update), lambda: generator.build_reference(items_dict, to_update, env))
+        # clean_html is timed for each page as part of build_reference.
+        clean = sum(timings['clean'] for timings in generator.build_profile.pages.itervalues())
+        phases.append({'name': 'clean_html', 'count': len(to_update), 'seconds': clean,
+            'per_second': len(to_update) / clean if clean else None, 'peak_rss_kb': phases[-1]['peak_rss_kb']})
+        phase('build_reference_index', len(items), lambda: generator.build_reference_index(items_dict, env))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(work_dir, ignore_errors=True)
+    with open(result_path, 'w') as f:
+        json.dump({'scale': scale, 'pages': pages, 'phases': phases}, f)
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+def measure_scale(scale, repeat):
+    '''
+    Run run_scale in a fresh process repeat times, keeping the median time
+    (and the lowest memory) of each phase. The median, rather than the best,
+    so that neither a lucky run nor an unlucky one sets the baseline.
+    '''
+    handle, result_path = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    runs = []
+    try:
+        for _ in range(repeat):
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), 'scale',
+                '--run-scale', str(scale), '--result', result_path])
+            with open(result_path) as f:
+                runs.append(json.load(f))
+    finally:
+        os.remove(result_path)
+    result = runs[0]
+    for number, phase in enumerate(result['phases']):
+        phases = [run['phases'][number] for run in runs]
+        phase['seconds'] = median([p['seconds'] for p in phases])
+        phase['per_second'] = phase['count'] / phase['seconds'] if phase['seconds'] else None
+        phase['peak_rss_kb'] = min(p['peak_rss_kb'] for p in phases)
+    return result
+
+def regressions(results, baseline, threshold, min_delta):
+    '''
+    The ways results are worse than baseline: a phase that takes longer by
+    more than min_delta seconds plus threshold (a fraction) of its baseline
+    time, or whose peak memory is more than threshold higher. Asking for both
+    keeps timer noise from counting, on short phases and on long ones.
+    '''
+    problems = []
+    for scale, result in sorted(results.iteritems()):
+        if scale not in baseline:
+            continue
+        base_phases = dict((phase['name'], phase) for phase in baseline[scale]['phases'])
+        for phase in result['phases']:
+            base = base_phases.get(phase['name'])
+            if base is None:
+                continue
+            if phase['seconds'] - base['seconds'] > min_delta + base['seconds'] * threshold:
+                problems.append('{}x {}: {:.3f}s, up from {:.3f}s'.format(
+                    scale, phase['name'], phase['seconds'], base['seconds']))
+            if (phase['peak_rss_kb'] and base['peak_rss_kb'] and
+                    phase['peak_rss_kb'] > base['peak_rss_kb'] * (1 + threshold)):
+                problems.append('{}x {}: peak memory {} KB, up from {} KB'.format(
+                    scale, phase['name'], phase['peak_rss_kb'], base['peak_rss_kb']))
+    return problems
+
+def bench_scale(scales, repeat, baseline_path, update_baseline, threshold, min_delta):
+    '''
+    Time the phases of building the reference (parsing, convert_hypertext,
+    build_reference and the clean_html part of it, build_reference_index) on
+    synthetic corpora scales times the size of the real reference, and
+    compare them with a baseline. With no baseline yet (or update_baseline),
+    the results become the baseline.
+    '''
+    print_header('scale')
+    results = {}
+    for scale in scales:
+        print('Building the reference at {}x...'.format(scale))
+        results[str(scale)] = result = measure_scale(scale, repeat)
+        print('{} pages, median of {}:'.format(result['pages'], repeat))
+        print('    {:<24} {:>10} {:>12} {:>14}'.format('phase', 'seconds', 'per second', 'peak RSS (KB)'))
+        for phase in result['phases']:
+            print('    {:<24} {:>10.3f} {:>12.0f} {:>14}'.format(phase['name'], phase['seconds'],
+                phase['per_second'] or 0, phase['peak_rss_kb'] or '-'))
+
+    baseline = None
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)['scales']
+    if baseline is None or update_baseline:
+        generator.write_json(baseline_path, {'scales': dict(baseline or {}, **results)})
+        print_success('Wrote the baseline to {}.'.format(baseline_path))
+        return 0
+    problems = regressions(results, baseline, threshold, min_delta)
+    for problem in problems:
+        print_error(problem)
+    if problems:
+        print_error('{} regression(s) against {}.'.format(len(problems), baseline_path))
+        return 1
+    print_success('No regressions against {}.'.format(baseline_path))
+    return 0
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmarks for generator.py')
+    subparsers = parser.add_subparsers(dest='command')
+    clean_html_parser = subparsers.add_parser('clean-html',
+            description='Compare clean_html with a full lxml round trip on the reference')
+    clean_html_parser.add_argument('--repeat', type=int, default=5, help='Number of times to time each step')
+    search_index_parser = subparsers.add_parser('search-index',
+            description='Measure the size of the reference search index and how fast lookups are')
+    search_index_parser.add_argument('--repeat', type=int, default=5, help='Number of times to time each step')
+    scale_parser = subparsers.add_parser('scale',
+            description='Time building the reference at several multiples of its size, against a baseline')
+    scale_parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100], metavar='N',
+            help='Sizes of corpus to build, as multiples of the real reference')
+    scale_parser.add_argument('--repeat', type=int, default=3,
+            help='Number of times to build each corpus; the median time of each phase is kept')
+    scale_parser.add_argument('--baseline', default='benchmark-baseline.json', metavar='FILE',
+            help='Results to compare with; written if it does not exist yet')
+    scale_parser.add_argument('--update-baseline', action='store_true', help='Replace the baseline with these results')
+    scale_parser.add_argument('--threshold', type=float, default=0.25,
+            help='Fraction by which a phase may be slower (or use more memory) than the baseline')
+    scale_parser.add_argument('--min-delta', type=float, default=0.1, metavar='SECONDS',
+            help='Slowdown allowed on top of the threshold, so that short phases are not flaky')
+    scale_parser.add_argument('--run-scale', type=int, help=SUPPRESS)
+    scale_parser.add_argument('--result', help=SUPPRESS)
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+    if args.command == 'clean-html':
+        sys.exit(bench_clean_html(args.repeat))
+    elif args.command == 'search-index':
+        sys.exit(bench_search_index(args.repeat))
+    elif args.command == 'scale':
+        if args.run_scale:
+            run_scale(args.run_scale, args.result)
+        else:
+            sys.exit(bench_scale(args.scales, args.repeat, args.baseline, args.update_baseline,
+                args.threshold, args.min_delta))
@@ -0,0 +1,115 @@
+// Instant search for the reference index page. The build writes the index of
+// reference items into /reference/search/, one JSON file per first letter
+// (see build_search_index in generator.py); a shard is fetched the first time
+// a query needs it. Each shard is a list of entries sorted by search key:
+// [key, name, flat name, category, subcategory, syntax, description].
+(function() {
+    var input = document.getElementById('reference-search');
+    var results = document.getElementById('reference-search-results');
+    if (!input || !results) {
+        return;
+    }
+    var limit = 20;
+    var shards = {};
+
+    // Keep these in step with search_key and search_shard in generator.py.
+    function searchKey(text) {
+        var key = text.toLowerCase().replace(/^[^a-z0-9]+/, '');
+        return key || text.toLowerCase();
+    }
+
+    function shardName(key) {
+        var c = key.charAt(0);
+        return c >= 'a' && c <= 'z' ? c : '_';
+    }
+
+    function loadShard(name, callback) {
+        if (shards.hasOwnProperty(name)) {
+            callback(shards[name]);
+            return;
+        }
+        var request = new XMLHttpRequest();
+        request.open('GET', '/reference/search/' + name + '.json');
+        request.onload = function() {
+            shards[name] = request.status == 200 ? JSON.parse(request.responseText) : [];
+            callback(shards[name]);
+        };
+        request.onerror = function() {
+            callback([]);
+        };
+        request.send();
+    }
+
+    // The entries starting with prefix are a run beginning at the first key
+    // that isn't less than it.
+    function lookup(entries, prefix) {
+        var low = 0, high = entries.length;
+        while (low < high) {
+            var middle = (low + high) >> 1;
+            if (entries[middle][0] < prefix) {
+                low = middle + 1;
+            } else {
+                high = middle;
+            }
+        }
+        var matches = [];
+        for (var i = low; i < entries.length && matches.length < limit; i++) {
+            if (entries[i][0].lastIndexOf(prefix, 0) !== 0) {
+                break;
+            }
+            matches.push(entries[i]);
+        }
+        return matches;
+    }
+
+    function element(tag, className, text) {
+        var e = document.createElement(tag);
+        if (className) {
+            e.className = className;
+        }
+        if (text) {
+            e.appendChild(document.createTextNode(text));
+        }
+        return e;
+    }
+
+    function show(matches) {
+        results.innerHTML = '';
+        for (var i = 0; i < matches.length; i++) {
+            var entry = matches[i];
+            var li = element('li');
+            var link = element('a', null, entry[1]);
+            link.href = '/reference/' + entry[2] + '.html';
+            li.appendChild(link);
+            var category = entry[4] ? entry[3] + ': ' + entry[4] : entry[3];
+            if (category) {
+                li.appendChild(element('span', 'category', category));
+            }
+            if (entry[5]) {
+                li.appendChild(element('code', null, entry[5]));
+            }
+            if (entry[6]) {
+                li.appendChild(element('p', null, entry[6]));
+            }
+            results.appendChild(li);
+        }
+    }
+
+    function search() {
+        var query = input.value.replace(/^\s+|\s+$/g, '');
+        if (!query) {
+            show([]);
+            return;
+        }
+        var key = searchKey(query);
+        loadShard(shardName(key), function(entries) {
+            // Answers can arrive after the user has typed something else.
+            if (input.value.replace(/^\s+|\s+$/g, '') === query) {
+                show(lookup(entries, key));
+            }
+        });
+    }
+
+    input.addEventListener('input', search);
+    search();
+})();
@@ -4,23 +4,49 @@ from argparse import ArgumentParser
 from cStringIO import StringIO
 
 import threading
+import multiprocessing
+import multiprocessing.pool
+import heapq
 import subprocess
+import socket
+import SocketServer
+import SimpleHTTPServer
+import urlparse
+import traceback
 import tempfile
 import os
 import re
 import shutil
-import distutils.core
+import hashlib
+import json
+import cPickle as pickle
+import zipfile
+import zlib
+import struct
+import distutils.spawn
 import sys
-import copy
 import cgi
 import time, datetime
+import contextlib
+import gzip
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+try:
+    import brotli
+except ImportError: # Optional; without it, no .br files are written
+    brotli = None
 
 import jinja2
+import jinja2.meta
 import lxml.html
 from lxml import etree # We need to use lxml because it can handle CDATA tags
 
 src_dir='.'
 target_dir=os.path.join(src_dir, 'generated/')
+# Things worth keeping between builds, but not worth publishing
+cache_dir=os.path.join(src_dir, '.build-cache/')
 
 # Names to use in links
 canon_reference_dir = '/reference/'
@@ -60,10 +86,93 @@ def print_warning(text):
 def print_success(text):
     print('\033[32m{}\033[0m'.format(text))
 
-class ReferenceItem:
+class XMLFragment(object):
+    '''
+    A piece of a reference item's XML (its description, say), kept as bytes
+    and only parsed when it's needed: mostly just the once, when
+    convert_hypertext turns it into HTML. Its url records which file, and
+    where in that file, it came from; convert_hypertext tells fragments apart
+    by it.
+    '''
+    __slots__ = ('url', 'xml')
+
+    def __init__(self, url, xml):
+        self.url = url
+        self.xml = xml
+
+    @classmethod
+    def from_element(cls, element):
+        if element is None:
+            return None
+        url, path = element_key(element)
+        if element.getparent() is not None:
+            url = '{}#{}'.format(url, path)
+        return cls(url, etree.tostring(element, with_tail=False))
+
+    def element(self):
+        '''Parse the fragment; each call gives a new element.'''
+        return etree.fromstring(self.xml, base_url=self.url)
+
+    def __getstate__(self):
+        return self.url, self.xml
+
+    def __setstate__(self, state):
+        self.url, self.xml = state
+
+class Example(object):
+    '''
+    An example on a reference page. wants_image says whether it should have
+    an image, and run whether it can be run; find_images sets image to the
+    url of the image we've generated (and size to its size), or broken if
+    there isn't one.
+    '''
+    __slots__ = ('code', 'wants_image', 'run', 'image', 'size', 'broken')
+
+    def __init__(self, code, wants_image, run, image=None, size=None, broken=False):
+        self.code = code
+        self.wants_image = wants_image
+        self.run = run
+        self.image = image
+        self.size = size
+        self.broken = broken
+
+class Parameter(object):
+    __slots__ = ('label', 'description')
+
+    def __init__(self, label, description):
+        self.label = label
+        self.description = description
+
+class Method(object):
+    __slots__ = ('label', 'description', 'ref')
+
+    def __init__(self, label, description, ref):
+        self.label = label
+        self.description = description
+        self.ref = ref
+
+def fragment_state(fragment):
+    return None if fragment is None else fragment.__getstate__()
+
+def fragment_from_state(state):
+    return None if state is None else XMLFragment(*state)
+
+class ReferenceItem(object):
     '''Represents a single page of reference information.'''
+
+    # Bump this whenever the attributes of ReferenceItem change, so that stale
+    # pickled items get thrown away.
+    cache_version = 4
+
+    # The whole reference is kept in memory (and handed to render workers), so
+    # items are kept small: slotted, with their XML kept as bytes.
+    __slots__ = ('source_xml', 'flatname', 'name', 'type', 'description', 'syntax', 'category',
+            'subcategory', 'usage', 'examples', 'parameters', 'methods', 'constructors', 'relateds', 'refs')
+
     def __init__(self, source_xml):
         self.source_xml = source_xml
+        # A flat name is the name of the file, sans .xml
+        self.flatname = os.path.basename(source_xml)[:-4]
         xml = etree.parse(source_xml)
 
         self.name = None
@@ -74,14 +183,6 @@ class ReferenceItem:
         if xml.find('type') is not None:
             self.type = self.get_element_text(xml.find('type'))
         
-        self.description = None
-        if xml.find('description') is not None:
-            self.description = xml.find('description')
-
-        self.syntax = None
-        if xml.find('syntax') is not None:
-            self.syntax = xml.find('syntax')
-
         self.category = None
         if xml.find('category') is not None:
             self.category = self.get_element_text(xml.find('category'))
@@ -94,31 +195,28 @@ class ReferenceItem:
         if xml.find('usage') is not None:
             self.usage = self.get_element_text(xml.find('usage'))
 
-                  
-        # We store plain xml-elements for some children so that we can use convert_hypertext on them at generation time.
+        # We keep the XML of some children so that we can use convert_hypertext on them at generation time.
         # This is necessary because all ReferenceItems have to be parsed before links can be resolved.
+        self.description = XMLFragment.from_element(xml.find('description'))
+        self.syntax = XMLFragment.from_element(xml.find('syntax'))
+
         self.examples = []
-        # Note: 'image' starts out as a flag representing whether this example wants an image or not.
-        # It is later transformed into the url of the image we've generated.
         for example in xml.iterfind('example'):
-            self.examples.append({
-                'code':   self.get_element_text(example.find('code')),
-                'image':  example.find('image') is not None,
-                'run':    example.find('notest') is None
-                })
+            self.examples.append(Example(self.get_element_text(example.find('code')),
+                example.find('image') is not None, example.find('notest') is None))
  
         self.parameters = []
         for parameter in xml.iterfind('parameter'):
             label = self.get_element_text(parameter.find('label'))
-            description = parameter.find('description')
-            self.parameters.append({'label':label, 'description':description})
+            description = XMLFragment.from_element(parameter.find('description'))
+            self.parameters.append(Parameter(label, description))
         
         self.methods = []
         for method in xml.iterfind('method'):
             label = self.get_element_text(method.find('label'))
-            description = method.find('description')
+            description = XMLFragment.from_element(method.find('description'))
             ref = create_ref_link(self.get_element_text(method.find('ref')))
-            self.methods.append({'label':label, 'description':description, 'ref':ref})
+            self.methods.append(Method(label, description, ref))
 
         self.constructors = []
         for constructor in xml.iterfind('constructor'):
@@ -128,6 +226,56 @@ class ReferenceItem:
         for related in xml.iterfind('related'):
             self.relateds.append(self.get_element_text(related))
 
+        # The pages that the <ref>s in the text link to, found while the XML
+        # is parsed anyway.
+        hypertext = ['description', 'syntax', 'parameter/description', 'method/description']
+        self.refs = sorted(set(ref_target(ref) for path in hypertext
+                for element in xml.iterfind(path) for ref in element.iter('ref')))
+
+    # Pickled items are kept in the cache. Their state is plain data, so that
+    # it can be read back whichever module these classes were loaded as.
+    def __getstate__(self):
+        state = dict((slot, getattr(self, slot)) for slot in self.__slots__)
+        state['description'] = fragment_state(self.description)
+        state['syntax'] = fragment_state(self.syntax)
+        state['examples'] = [tuple(getattr(e, slot) for slot in Example.__slots__) for e in self.examples]
+        state['parameters'] = [(p.label, fragment_state(p.description)) for p in self.parameters]
+        state['methods'] = [(m.label, fragment_state(m.description), m.ref) for m in self.methods]
+        return state
+
+    def __setstate__(self, state):
+        for slot in self.__slots__:
+            setattr(self, slot, state[slot])
+        self.description = fragment_from_state(state['description'])
+        self.syntax = fragment_from_state(state['syntax'])
+        self.examples = [Example(*example) for example in state['examples']]
+        self.parameters = [Parameter(label, fragment_from_state(description))
+                for label, description in state['parameters']]
+        self.methods = [Method(label, fragment_from_state(description), ref)
+                for label, description, ref in state['methods']]
+
+    def hypertext_fragments(self):
+        '''The fragments that get run through convert_hypertext when the page is rendered.'''
+        fragments = [self.description, self.syntax]
+        fragments += [parameter.description for parameter in self.parameters]
+        fragments += [method.description for method in self.methods]
+        return [fragment for fragment in fragments if fragment is not None]
+
+    def hypertext_elements(self):
+        '''The hypertext fragments, parsed (afresh, each time).'''
+        return [fragment.element() for fragment in self.hypertext_fragments()]
+
+    def linked_names(self):
+        '''Flat names of the pages whose display names appear on this page.'''
+        return set(self.relateds) | set(self.refs)
+
+    @classmethod
+    def from_state(cls, state):
+        '''Recreate an item from the output of __getstate__.'''
+        item = cls.__new__(cls)
+        item.__setstate__(state)
+        return item
+
     def get_element_text(self, element):
         '''Get element.text, supplying the empty string if element.text is None. Take filename so we can point to errors.'''
         text = element.text
@@ -136,122 +284,975 @@ class ReferenceItem:
             text = ''
         return text
 
+def link_or_copy(src, dst):
+    '''Hard-link src to dst (replacing dst), falling back to a copy where links aren't supported.'''
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        shutil.copy2(src, dst)
+
+def write_file(path, data):
+    '''
+    Write data to path, creating its directory if need be. The new file is
+    written alongside and renamed into place, so a build that stops partway
+    never leaves a half-written one. Compressed copies of the old file are
+    removed (see compress_outputs).
+    '''
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.rename(temp_path, path)
+    remove_compressed(path)
+
+def write_json(path, data):
+    '''Write data to path as JSON, replacing the old file only once the new one is complete.'''
+    write_file(path, json.dumps(data, indent=1, sort_keys=True))
+
+def file_stamp(path):
+    '''The size and mtime of path; while they stay the same, the file is taken not to have changed.'''
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+def file_digest(path, entry=None):
+    '''
+    Return [size, mtime, SHA-1] for path. entry is what this returned for
+    path last time, if anything: while the file's size and mtime match it,
+    its hash is taken from there instead of the file being read again.
+    '''
+    stamp = file_stamp(path)
+    if entry and entry[:2] == stamp:
+        return stamp + [entry[2]]
+    with open(path, 'rb') as f:
+        return stamp + [hashlib.sha1(f.read()).hexdigest()]
+
+def write_if_changed(path, data):
+    '''
+    Write data to path with write_file, unless that's what path already
+    holds, so that files that haven't changed keep their mtime. Returns
+    whether path was written.
+    '''
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    return False
+    except (OSError, IOError): # Not there yet
+        pass
+    write_file(path, data)
+    return True
+
+def build_timestamp(timestamp=False):
+    '''
+    The time reference pages say they were updated: the time given by
+    SOURCE_DATE_EPOCH, if it's set, or else now, if timestamp is set. Otherwise
+    None, and pages leave it out, so that a page only changes when its content
+    does.
+    '''
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if epoch:
+        return datetime.datetime.utcfromtimestamp(int(epoch)).ctime()
+    if timestamp:
+        return datetime.datetime.now().ctime()
+    return None
+
+def build_date():
+    '''The date of this build, as a sitemap gives it: from SOURCE_DATE_EPOCH, if it's set.'''
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if epoch:
+        return datetime.datetime.utcfromtimestamp(int(epoch)).date().isoformat()
+    return datetime.date.today().isoformat()
+
+def cpu_time():
+    '''CPU time used by this process and the children it has waited for (JVMs, page renderers).'''
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+def peak_rss():
+    '''Peak resident set size of this process and of its largest child, in kilobytes.'''
+    if resource is None:
+        return None
+    scale = 1024 if sys.platform == 'darwin' else 1 # macOS reports bytes
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale,
+    }
+
+class BuildProfile(object):
+    '''
+    Where a build spends its time: wall and CPU time for each phase, and how
+    long each page took to render and clean, and each example to run. Timing
+    is cheap, so it's always collected; `build --profile` writes it out.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.phases = []
+        self.pages = {}
+        self.examples = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        wall, cpu = time.time(), cpu_time()
+        try:
+            yield
+        finally:
+            self.phases.append({'name': name, 'wall': time.time() - wall, 'cpu': cpu_time() - cpu})
+
+    def page(self, name, timings):
+        '''Record a page's timings, a dictionary from step (e.g. 'render', 'clean') to seconds.'''
+        self.pages[name] = timings
+
+    def example(self, name, seconds, status):
+        self.examples[name] = {'seconds': seconds, 'status': status}
+
+    def report(self):
+        totals = {}
+        for timings in self.pages.itervalues():
+            for step, seconds in timings.iteritems():
+                totals[step] = totals.get(step, 0) + seconds
+        return {
+            'phases': self.phases,
+            'wall': sum(phase['wall'] for phase in self.phases),
+            'cpu': sum(phase['cpu'] for phase in self.phases),
+            'page_totals': totals,
+            'pages': self.pages,
+            'examples': self.examples,
+            'peak_rss_kb': peak_rss(),
+        }
+
+    def print_summary(self, top):
+        report = self.report()
+        print_header('Build profile')
+        print('{:<32} {:>9} {:>9}'.format('phase', 'wall (s)', 'cpu (s)'))
+        for phase in report['phases']:
+            print('{:<32} {:>9.3f} {:>9.3f}'.format(phase['name'], phase['wall'], phase['cpu']))
+        print('{:<32} {:>9.3f} {:>9.3f}'.format('total', report['wall'], report['cpu']))
+        for step, seconds in sorted(report['page_totals'].iteritems()):
+            print('Time spent on {} across all pages: {:.3f}s'.format(step, seconds))
+        if report['peak_rss_kb']:
+            print('Peak RSS: {self} KB (largest child: {children} KB)'.format(**report['peak_rss_kb']))
+        slowest_pages = sorted(self.pages.iteritems(), key=lambda (name, timings): -sum(timings.itervalues()))
+        if slowest_pages:
+            print('Slowest pages:')
+            for name, timings in slowest_pages[:top]:
+                steps = ', '.join('{} {:.1f} ms'.format(step, seconds * 1000) for step, seconds in sorted(timings.iteritems()))
+                print('    {:<40} {}'.format(name, steps))
+        slowest_examples = sorted(self.examples.iteritems(), key=lambda (name, example): -example['seconds'])
+        if slowest_examples:
+            print('Slowest examples:')
+            for name, example in slowest_examples[:top]:
+                print('    {:<40} {:.1f} ms ({})'.format(name, example['seconds'] * 1000, example['status']))
+
+    def save(self, path):
+        write_json(path, self.report())
+
+# The profile of the build in progress
+build_profile = BuildProfile()
+
 export_image_postlude = r'''
 save('{imagefile}')
 exit()
 '''
 
-# run an instance of generate_images.py, capturing and recording its output.
-# base_cmd should be a list-formatted command-line to run the
-# generate_images.py script, suitable for passing to subprocess.Popen;
-# workitems should be a list of dictionaries describing the scripts to be run.
-def image_worker(base_cmd, workitems):
-
-    workitems_cmdline_param = ['{}:{}:{}'.format(ex['name'], ex['scriptfile'], ex['imagefile']) \
-            for ex in workitems.itervalues()]
-    process = subprocess.Popen(base_cmd + workitems_cmdline_param, stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT, bufsize=1)
-    generated = {}
-    failed = {}
+# Serializes console output from concurrently running image processes, so
+# that lines printed in several parts don't get interleaved.
+print_lock = threading.Lock()
+
+def format_workitem(workitem, absolute=False):
+    '''
+    Format a workitem the way generate_images.py reads it from its stdin: a
+    line of JSON, carrying the example's code along with it. The code ends
+    with the workitem's postlude, if it has one, or else with the one that
+    saves its image.
+    '''
+    scriptfile, imagefile = workitem['scriptfile'], workitem['imagefile']
+    if absolute:
+        scriptfile, imagefile = os.path.abspath(scriptfile), os.path.abspath(imagefile)
+    return json.dumps({
+        'name': workitem['name'],
+        'scriptfile': scriptfile,
+        'imagefile': imagefile,
+        'code': workitem['example_code'] + workitem.get('postlude', export_image_postlude).format(imagefile=imagefile),
+    })
+
+# generate_images.py's messages to us are lines of JSON after this prefix;
+# anything else it prints is the output of the sketches themselves.
+event_prefix = ':EVENT:'
+
+def parse_event(line):
+    '''The message on a line of generate_images.py's output, or None if it's just output.'''
+    if line.startswith(event_prefix):
+        try:
+            return json.loads(line[len(event_prefix):])
+        except ValueError:
+            pass
+    return None
+
+class ImageResults(object):
+    '''
+    Takes the results of the image processes as they arrive. Each example's
+    image goes into the image cache, and its timings into the build profile
+    and a report in the cache (a line of JSON per example); only the number
+    of images generated, the names of failed examples (and of those that
+    were never run, status 'missing') and the slowest examples are kept. The
+    cache is None if the images aren't to be cached.
+    '''
+    def __init__(self, cache, report_path, keep_slowest=5):
+        self.cache = cache
+        self.report = open(report_path, 'w')
+        self.lock = threading.Lock()
+        self.generated = 0
+        self.failed = []
+        self.missing = []
+        self.keep_slowest = keep_slowest
+        self.slowest = [] # A heap of (seconds, name)
+
+    def add(self, workitem, label, message):
+        '''Record the result of running a workitem; message is its result event.'''
+        status = message.get('status', 'failure')
+        with self.lock:
+            if status == 'success':
+                self.generated += 1
+                if self.cache is not None:
+                    self.cache.store(workitem['key'], workitem['imagefile'])
+            elif status == 'missing':
+                self.missing.append(workitem['name'])
+            else:
+                self.failed.append(workitem['name'])
+            if 'seconds' in message:
+                build_profile.example(workitem['name'], message['seconds'],
+                        'generated' if status == 'success' else 'failed')
+                heapq.heappush(self.slowest, (message['seconds'], workitem['name']))
+                if len(self.slowest) > self.keep_slowest:
+                    heapq.heappop(self.slowest)
+            record = dict(message, name=workitem['name'], status=status, process=label)
+            record.pop('event', None)
+            self.report.write(json.dumps(record, sort_keys=True) + '\n')
+            self.report.flush()
+
+    def problem(self, label, error):
+        '''Count a failure that isn't any one example's, like an image process that wouldn't start.'''
+        with self.lock:
+            self.failed.append('PROBLEM ' + label)
+            self.report.write(json.dumps({'name': None, 'status': 'failure', 'process': label, 'error': error}) + '\n')
+            self.report.flush()
+
+    def close(self):
+        self.report.close()
+
+# Seconds an example may run before its image process is killed
+default_image_timeout = 30
+
+class Watchdog(object):
+    '''
+    Keeps an eye on the example an image process is running, calling kill if
+    it runs for longer than timeout seconds (or never, if timeout is 0 or
+    None). The example that was killed ends up in expired.
+    '''
+    def __init__(self, timeout, kill):
+        self.timeout = timeout
+        self.kill = kill
+        self.lock = threading.Lock()
+        self.current = None
+        self.started = None
+        self.expired = None
+        self.stopped = threading.Event()
+        self.thread = None
+        if timeout:
+            self.thread = threading.Thread(target=self.watch)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def running(self, workitem):
+        with self.lock:
+            self.current = workitem
+            self.started = time.time()
+
+    def finished(self):
+        with self.lock:
+            self.current = None
+
+    def watch(self):
+        while not self.stopped.wait(min(1, self.timeout / 10)):
+            with self.lock:
+                if self.current is not None and time.time() - self.started > self.timeout:
+                    self.expired = self.current
+                    self.kill()
+                    return
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+# Echo the output of generate_images.py, and pass the result of each workitem
+# it runs on to results as soon as it arrives. lines is any iterable of output
+# lines. Returns the names of the workitems that finished, along with the
+# workitem that was running when the output stopped (if any). A watchdog, if
+# given, is told which workitem is running.
+def read_image_output(lines, workitems, label, results, watchdog=None):
+    finished = set()
     current = None
-
-    for line in iter(process.stdout.readline, ''):
-        m = re.search(r'^:RUNNING:(.+)$', line)
-        if m:
-            current = workitems[m.group(1)]
-            print("{} ... RUNNING: {}".format('Image process', current['name']))
-            continue
-        m = re.search(r'^:SUCCESS:$', line)
-        if m:
-            print("{} ... SUCCESS: ".format('Image process'), end='')
-            print_success("{} -> {}".format(current['name'], current['imagefile']))
-            generated[current['name']] = current
-            current = None
+    for line in lines:
+        message = parse_event(line)
+        if message is None:
+            # Not a message, must be debug output
+            with print_lock:
+                print("{} ... DEBUG: {}".format(label, line), end='')
             continue
-        m = re.search(r'^:FAILURE:$', line)
-        if m:
-            print("{} ... FAILURE: ".format('Image process'), end='')
-            print_error(current['name'])
-            failed[current['name']] = current
+        if message['event'] == 'running':
+            current = workitems[message['name']]
+            if watchdog:
+                watchdog.running(current)
+            with print_lock:
+                print("{} ... RUNNING: {}".format(label, current['name']))
+        elif message['event'] == 'result':
+            workitem = workitems[message['name']]
+            if watchdog:
+                watchdog.finished()
+            with print_lock:
+                if message['status'] == 'success':
+                    print("{} ... SUCCESS: ".format(label), end='')
+                    print_success("{} -> {} ({:.2f}s)".format(workitem['name'], workitem['imagefile'],
+                        message.get('seconds', 0)))
+                else:
+                    print("{} ... FAILURE: ".format(label), end='')
+                    print_error(workitem['name'])
+            results.add(workitem, label, message)
+            finished.add(workitem['name'])
             current = None
-            continue
-        # Not a success or failure, must be debug messages
-        print("{} ... DEBUG: {}".format('Image process', line), end='')
+    return finished, current
 
-    process.wait()
-    if process.returncode == 0:
-        print("Image process terminated successfully.")
-    else:
-        print_error("Image process terminated unsuccessfully.")
-        if current:
-            failed[current['name']] = current
-        # if the process just plain exited without doing anything,
-        # add a sentinel value so it "counts" as an error in the calling
-        # code (FIXME this is a hack)
-        if len(failed) == 0:
-            failed['PROBLEM'] = {'name': 'problem'}
-    return generated, failed
-
-def generate_images(items_dict, to_update, src_dir, processing_py_jar,
-        target_image_dir, javabin="java"):
-    '''Generate images from examples and return the number of failures.'''
-    workitems  = {} # Examples to run
-    work_dir   = tempfile.mkdtemp(prefix='processing-py-site-build')
+def fail_unfinished(workitems, finished, current, label, results, error):
+    '''Count the workitems an image process didn't get to (or died running) as failures.'''
+    for name, workitem in workitems.iteritems():
+        if name not in finished:
+            reason = error if workitem is current else 'not run: ' + error
+            results.add(workitem, label, {'status': 'failure', 'error': reason})
+
+# run generate_images.py, feeding it workitems and passing its results on to
+# results. base_cmd should be a list-formatted command-line to run the
+# generate_images.py script, suitable for passing to subprocess.Popen;
+# workitems should be a dictionary of workitems by name; label is the prefix
+# used when echoing the process's output. An example that runs for longer
+# than timeout seconds is killed, along with its process, and counts as a
+# failure; so does one whose process dies under it. Either way, a new process
+# is started for the examples that remain.
+def image_worker(base_cmd, workitems, results, label='Image process', timeout=default_image_timeout):
+    pending = workitems
+    while pending:
+        finished, current, returncode, expired = run_image_process(base_cmd, pending, results, label, timeout)
+        with print_lock:
+            if returncode == 0:
+                print("{} terminated successfully.".format(label))
+            elif expired:
+                print_error("{} killed after {} running for more than {:g} seconds.".format(
+                    label, expired['name'], timeout))
+            else:
+                print_error("{} terminated unsuccessfully.".format(label))
+        if returncode == 0:
+            break
+        error = '{} exited with status {}'.format(label, returncode)
+        if expired:
+            results.add(expired, label, {'status': 'failure', 'seconds': timeout,
+                'error': 'timed out after {:g} seconds'.format(timeout)})
+        elif current:
+            results.add(current, label, {'status': 'failure', 'error': error})
+        else:
+            # It died between examples (or before the first), so a new process
+            # wouldn't necessarily get any further.
+            if len(finished) == len(pending):
+                # Everything ran, but something went wrong; make sure it
+                # "counts" as an error in the calling code.
+                results.problem(label, error)
+            fail_unfinished(pending, finished, None, label, results, error)
+            break
+        pending = dict((name, workitem) for name, workitem in pending.iteritems()
+                if name not in finished and workitem is not current)
+        if pending:
+            with print_lock:
+                print_warning("{} restarting for the {} remaining example(s).".format(label, len(pending)))
+
+def run_image_process(base_cmd, workitems, results, label, timeout):
+    '''
+    Run one instance of generate_images.py on workitems. Returns the names of
+    the workitems that finished, the one it was running when it stopped (if
+    any), its exit status, and the workitem the watchdog killed it over (if
+    any).
+    '''
+    process = subprocess.Popen(base_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, bufsize=1)
+    # Feed the workitems from another thread, so that neither of us can end up
+    # stuck writing to a full pipe. Closing stdin tells the process to exit
+    # once it's done.
+    def feed():
+        try:
+            for workitem in workitems.itervalues():
+                process.stdin.write(format_workitem(workitem) + '\n')
+            process.stdin.close()
+        except IOError: # The process died; its exit status tells the story
+            pass
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    watchdog = Watchdog(timeout, process.kill)
+    try:
+        finished, current = read_image_output(iter(process.stdout.readline, ''), workitems, label,
+                results, watchdog)
+        process.wait()
+    finally:
+        watchdog.stop()
+    feeder.join()
+    return finished, current, process.returncode, watchdog.expired
+
+# Where `generator.py serve-renderer` listens, unless told otherwise. It's a
+# Unix domain socket that only its owner can connect to: whatever connects
+# can run any code it likes in the render server's JVM.
+render_server_socket = os.path.join(cache_dir, 'render-server.sock')
+
+# Send workitems to a renderer started with `generator.py serve-renderer`,
+# rather than starting a JVM of our own. The server relays the output of its
+# generate_images.py process, then hangs up when the batch is done.
+def render_server_worker(path, workitems, results, label='Render server'):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except socket.error as e:
+        connection.close()
+        print_error("Can't reach the render server at {}: {}".format(path, e))
+        results.problem(label, str(e))
+        return
+    try:
+        request = ''.join(format_workitem(ex, absolute=True) + '\n' for ex in workitems.itervalues())
+        connection.sendall(request + '\n') # A blank line ends the batch
+        response = connection.makefile('r')
+        finished, current = read_image_output(iter(response.readline, ''), workitems, label, results)
+    finally:
+        connection.close()
+    # Anything the server didn't get to (say, because its JVM died) counts as
+    # a failure.
+    fail_unfinished(workitems, finished, current, label, results, 'the render server stopped')
+
+def local_render_worker(renderer, workitems, results, label='Image process'):
+    '''
+    Render workitems with renderer, a RenderServer running in this process,
+    reading its output as render_server_worker reads a render server's.
+    '''
+    read_fd, write_fd = os.pipe()
+    specs = [format_workitem(ex, absolute=True) for ex in workitems.itervalues()]
+    def render():
+        with os.fdopen(write_fd, 'w') as out:
+            renderer.render(specs, out)
+    thread = threading.Thread(target=render)
+    thread.start()
+    try:
+        with os.fdopen(read_fd) as response:
+            finished, current = read_image_output(iter(response.readline, ''), workitems, label, results)
+    finally:
+        thread.join()
+    fail_unfinished(workitems, finished, current, label, results, 'the image process stopped')
+
+def shard_workitems(workitems, jobs):
+    '''Split workitems into at most jobs dictionaries of roughly equal size.'''
+    shards = [{} for _ in range(max(1, min(jobs, len(workitems))))]
+    # Deal the examples out round-robin, so that pages with many examples
+    # (which sort next to each other) end up spread across the shards.
+    for number, name in enumerate(sorted(workitems)):
+        shards[number % len(shards)][name] = workitems[name]
+    return shards
+
+def sharded_image_worker(base_cmd, workitems, results, jobs, timeout=default_image_timeout):
+    '''
+    Run the workitems across jobs instances of generate_images.py at once.
+    Each shard gets its own JVM; they all pass their results on to results.
+    '''
+    shards = shard_workitems(workitems, jobs)
+    if len(shards) == 1:
+        image_worker(base_cmd, shards[0], results, timeout=timeout)
+        return
+
+    # The heavy lifting happens in the JVMs, so a thread per shard is
+    # plenty to pump their output.
+    def run_shard(number):
+        image_worker(base_cmd, shards[number], results, 'Image process {}'.format(number + 1), timeout)
+    threads = [threading.Thread(target=run_shard, args=(number,)) for number in range(len(shards))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def image_process_cmd(src_dir, processing_py_jar, javabin="java"):
+    '''The command line that starts generate_images.py, which then reads workitems from its stdin.'''
     generate_img_script = os.path.join(src_dir, 'jython', 'generate_images.py')
     if not os.path.exists(generate_img_script):
         raise IOError("{} doesn't exist; can't generate images.".format(generate_img_script))
+    return [javabin, "-cp", processing_py_jar, "org.python.util.jython", generate_img_script]
+
+def jar_version(processing_py_jar):
+    '''Identify a processing-py.jar build, for telling images it rendered apart from another's.'''
+    if not os.path.exists(processing_py_jar):
+        return 'missing'
+    version = 'unknown'
+    try:
+        manifest = zipfile.ZipFile(processing_py_jar).read('META-INF/MANIFEST.MF')
+        m = re.search(r'^Implementation-Version:\s*(.+?)\s*$', manifest, re.MULTILINE)
+        if m:
+            version = m.group(1)
+    except (zipfile.BadZipfile, KeyError):
+        pass
+    # Locally built jars tend to share a version number, so throw in the size too.
+    return '{}:{}'.format(version, os.path.getsize(processing_py_jar))
+
+def image_key(code, renderer_version, postlude=export_image_postlude):
+    '''A hash of everything that goes into an example's image (or, with check_postlude, its check).'''
+    h = hashlib.sha1()
+    for part in (code, postlude, renderer_version):
+        h.update(part.encode('utf-8'))
+        h.update('\0')
+    return h.hexdigest()
+
+class ImageCache(object):
+    '''
+    Rendered example images, stored under a hash of everything that goes into
+    rendering them: the example code, the postlude that saves the image, and
+    the version of the render backend that runs it (for the Jython backend,
+    its processing-py.jar). An index records which images each
+    reference page's examples currently use, so that images nothing refers to
+    any more can be pruned.
+    '''
+    def __init__(self, cache_dir, renderer_version):
+        self.dir = os.path.join(cache_dir, 'images')
+        self.index_path = os.path.join(self.dir, 'index.json')
+        self.renderer_version = renderer_version
+        self.pages = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.pages = json.load(f)['pages']
+
+    def key(self, code):
+        return image_key(code, self.renderer_version)
+
+    def path(self, key):
+        return os.path.join(self.dir, key + '.png')
+
+    def fetch(self, key, imagefile):
+        '''Put the cached image for key at imagefile, returning whether there was one.'''
+        if not os.path.exists(self.path(key)):
+            return False
+        link_or_copy(self.path(key), imagefile)
+        return True
+
+    def store(self, key, imagefile):
+        if os.path.exists(imagefile):
+            link_or_copy(imagefile, self.path(key))
+
+    def record(self, flat_name, keys):
+        '''Note the keys of the images that a page's examples use.'''
+        self.pages[flat_name] = keys
+
+    def prune(self, flat_names):
+        '''Forget pages that aren't in flat_names and delete images that no page uses.'''
+        for flat_name in list(self.pages):
+            if flat_name not in flat_names:
+                del self.pages[flat_name]
+        used = set(key for keys in self.pages.itervalues() for key in keys)
+        pruned = 0
+        for filename in os.listdir(self.dir):
+            if filename.endswith('.png') and filename[:-4] not in used:
+                os.remove(os.path.join(self.dir, filename))
+                pruned += 1
+        return pruned
+
+    def save(self):
+        write_json(self.index_path, {'pages': self.pages})
+
+class RenderBackend(object):
+    '''
+    Turns example workitems into images, passing the result of each on to an
+    ImageResults. version identifies what renders the images, so that the
+    image cache can tell its images apart from another backend's; a backend
+    whose images shouldn't be cached at all has a version of None.
+    '''
+    label = 'Renderer'
+
+    def version(self):
+        return None
+
+    def source(self):
+        '''
+        What the backend's images are made by, as the dependency graph records
+        it: an image from a backend with another source is a different image.
+        '''
+        return self.version()
+
+    def run(self, workitems, results):
+        raise NotImplementedError
+
+    def keep_running(self):
+        '''Keep whatever runs the examples going between calls to run, until stop is called.'''
+
+    def stop(self):
+        pass
+
+class JythonBackend(RenderBackend):
+    '''
+    Runs the examples with generate_images.py in processing-py.jar's Jython,
+    in JVMs of its own (jobs of them at once) or in a render server's. After
+    keep_running, it keeps a single JVM of its own going between runs.
+    '''
+    label = 'Image process'
+
+    def __init__(self, src_dir, processing_py_jar, javabin="java", jobs=1, render_server=None,
+            timeout=default_image_timeout):
+        self.base_cmd = image_process_cmd(src_dir, processing_py_jar, javabin)
+        self.processing_py_jar = processing_py_jar
+        # Reading the jar's directory is slow, and it's asked for page by page.
+        self.jar_version = jar_version(processing_py_jar)
+        self.jobs = jobs
+        self.render_server = render_server
+        self.timeout = timeout
+        self.renderer = None
+
+    def version(self):
+        return self.jar_version
+
+    def run(self, workitems, results):
+        if self.render_server:
+            render_server_worker(self.render_server, workitems, results)
+        elif self.renderer is not None:
+            local_render_worker(self.renderer, workitems, results)
+        else:
+            sharded_image_worker(self.base_cmd, workitems, results, self.jobs, self.timeout)
+
+    def keep_running(self):
+        if not self.render_server and self.renderer is None:
+            self.renderer = RenderServer(self.base_cmd, self.timeout)
+
+    def stop(self):
+        if self.renderer is not None:
+            self.renderer.stop()
+            self.renderer = None
+
+class CacheOnlyBackend(RenderBackend):
+    '''
+    Runs nothing: examples get the images the Jython backend has cached for
+    them, and those without one are left without an image.
+    '''
+    label = 'Image cache'
+
+    def __init__(self, processing_py_jar):
+        self.processing_py_jar = processing_py_jar
+        self.jar_version = jar_version(processing_py_jar)
+
+    def version(self):
+        return self.jar_version
+
+    def run(self, workitems, results):
+        for workitem in workitems.itervalues():
+            results.add(workitem, self.label, {'status': 'missing', 'error': 'no cached image'})
+
+# The size() call at the top of a static sketch
+sketch_size_pattern = re.compile(r'^\s*size\(\s*(\d+)\s*,\s*(\d+)', re.MULTILINE)
+
+def sketch_size(code):
+    '''The width and height a sketch declares, or Processing's default of 100x100.'''
+    m = sketch_size_pattern.search(code)
+    if m:
+        return int(m.group(1)), int(m.group(2))
+    return 100, 100
+
+def placeholder_png(width, height):
+    '''A PNG of the given size in Processing's default grey background.'''
+    row = '\0' + '\xcc' * width # No filter, then a row of 8-bit grey pixels
+    header = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    return (png_signature + png_chunk('IHDR', header) +
+            png_chunk('IDAT', zlib.compress(row * height, 9)) + png_chunk('IEND', ''))
+
+class StubBackend(RenderBackend):
+    '''
+    Runs nothing and needs no Java: every example gets a blank placeholder
+    image the size its sketch declares. For checking the pages and their image
+    links quickly; the placeholders are never cached.
+    '''
+    label = 'Stub renderer'
+
+    def source(self):
+        return 'stub'
+
+    def run(self, workitems, results):
+        for workitem in workitems.itervalues():
+            start = time.time()
+            width, height = sketch_size(workitem['example_code'])
+            data = placeholder_png(width, height)
+            with open(workitem['imagefile'], 'wb') as f:
+                f.write(data)
+            results.add(workitem, self.label, {'status': 'success', 'seconds': time.time() - start,
+                'bytes': len(data), 'width': width, 'height': height})
+
+render_backends = ('jython', 'cache-only', 'stub')
+
+def make_render_backend(name, jobs=1, render_server=None, timeout=default_image_timeout, javabin="java"):
+    '''The render backend called name (one of render_backends).'''
+    processing_py_jar = "./processing-py.jar"
+    if name == 'stub':
+        return StubBackend()
+    elif name == 'cache-only':
+        return CacheOnlyBackend(processing_py_jar)
+    return JythonBackend(src_dir, processing_py_jar, javabin, jobs, render_server, timeout)
+
+def generate_images(items_dict, to_update, backend, target_image_dir):
+    '''Generate images from examples with a RenderBackend and return the number of failures.'''
+    cache = None
+    if backend.version() is not None:
+        cache = ImageCache(cache_dir, backend.version())
+        if not os.path.exists(cache.dir):
+            os.makedirs(cache.dir)
+    # The sketches' home directory. Their code is sent down a pipe, so
+    # nothing is written here unless a sketch saves something of its own.
+    work_dir = tempfile.mkdtemp(prefix='processing-py-site-build')
+    try:
+        return run_examples(items_dict, to_update, backend, cache, work_dir, target_image_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def run_examples(items_dict, to_update, backend, cache, work_dir, target_image_dir):
+    '''
+    The work of generate_images, which removes work_dir afterwards. cache is
+    None if the backend's images aren't cached.
+    '''
+    workitems  = {} # Examples to run
+    cached = 0
 
     for name in to_update:
         item = items_dict[name]
+        keys = []
         for number, example in enumerate(item.examples):
-            if not example['run']:
+            if not example.run:
                 # This is an interactive sketch we can't run; ignore it
                 continue
             workitem = {}
             workitem['name'] = name + str(number)
             workitem['scriptfile'] = os.path.join(work_dir, workitem['name'] + '.py')
             workitem['imagefile'] = os.path.join(target_image_dir, workitem['name'] + '.png')
-            workitem['code']= example['code'] + export_image_postlude.format(imagefile=workitem['imagefile'])
-            with open(workitem['scriptfile'], 'w') as f:
-                f.write(workitem['code'])
+            # The old image may be a hard link into the cache, so get it out of
+            # the way rather than letting the sketch write through it.
+            if os.path.lexists(workitem['imagefile']):
+                os.remove(workitem['imagefile'])
+            if cache is not None:
+                workitem['key'] = cache.key(example.code)
+                keys.append(workitem['key'])
+                if cache.fetch(workitem['key'], workitem['imagefile']):
+                    cached += 1
+                    continue
+            workitem['example_code'] = example.code # Not a copy; the postlude is added as it's sent
             workitems[workitem['name']] = workitem # We store workitems by name; a little redundant, but handy
+        if cache is not None:
+            cache.record(name, keys)
+
+    if cached:
+        print("Reused {} cached example image(s)".format(cached))
+    if cache is not None:
+        pruned = cache.prune(set(items_dict) - set(['']))
+        if pruned:
+            print("Pruned {} unused image(s) from the cache".format(pruned))
 
     if len(workitems) == 0:
+        if cache is not None:
+            cache.save()
         print("Skipping image generation, everything up to date") 
         return 0
 
-    base_cmd = [javabin, "-cp", processing_py_jar, "org.python.util.jython",
-            generate_img_script, '--todo']
+    report_path = os.path.join(cache_dir, 'image-report.jsonl')
+    results = ImageResults(cache, report_path)
+    try:
+        backend.run(workitems, results)
+    finally:
+        results.close()
+        if cache is not None:
+            cache.save()
+
+    print("Generated {} image(s); the report on each example is in {}".format(results.generated, report_path))
+    if results.missing:
+        print_warning("{} example(s) had no image to use".format(len(results.missing)))
+    if results.slowest:
+        print("Slowest examples:")
+        for seconds, name in sorted(results.slowest, reverse=True):
+            print("    {:8.2f}s  {}".format(seconds, name))
+    if results.failed:
+        print("Failed examples:")
+        for name in sorted(results.failed):
+            print("    ", name)
 
-    # TODO: use the multiprocessing module's Pool class to run multiple
-    # instances of this at once
-    generated, failed = image_worker(base_cmd, workitems) 
+    print("Done rendering examples.")
+    return len(results.failed)
 
-    print("Generated images:")
-    for workitem in generated.itervalues():
-        print("    ", workitem['imagefile'])
+# Ends an example that's only being checked: it just has to run to the end.
+check_postlude = r'''
+exit()
+'''
 
-    print("Failed examples:")
-    for workitem in failed.itervalues():
-        print("    ", workitem['name'])
-    
-    print("Done rendering examples.")
+class ExampleChecks(object):
+    '''
+    The outcome of running each example without saving its image, stored in
+    the cache under a hash of the example code and the processing-py.jar that
+    ran it, so that only changed examples (and ones that failed) have to run
+    again. It takes results from the image workers, as ImageResults does.
+    '''
+    def __init__(self, path, renderer_version):
+        self.path = path
+        self.renderer_version = renderer_version
+        self.lock = threading.Lock()
+        self.results = {}
+        self.problems = []
+        if os.path.exists(path):
+            with open(path) as f:
+                self.results = json.load(f)['results']
+
+    def key(self, code):
+        return image_key(code, self.renderer_version, check_postlude)
+
+    def get(self, key):
+        return self.results.get(key)
+
+    def passed(self, key):
+        return (self.results.get(key) or {}).get('status') == 'success'
+
+    def add(self, workitem, label, message):
+        result = {'status': message.get('status', 'failure'), 'seconds': message.get('seconds')}
+        if message.get('error'):
+            result['error'] = message['error']
+        with self.lock:
+            self.results[workitem['key']] = result
+
+    def problem(self, label, error):
+        with self.lock:
+            self.problems.append('{}: {}'.format(label, error))
+
+    def save(self, keys):
+        '''Save the results for keys, forgetting the rest.'''
+        self.results = dict((key, result) for key, result in self.results.iteritems() if key in keys)
+        write_json(self.path, {'results': self.results})
+
+def write_junit_report(path, cases, checks):
+    '''
+    Write a JUnit-style XML report of the examples checked. cases is a list of
+    (flat name, example name, key), with a key of None for examples that
+    aren't run.
+    '''
+    suite = etree.Element('testsuite', name='examples')
+    counts = {'tests': 0, 'failures': 0, 'errors': 0, 'skipped': 0}
+    total = 0
+    for flat_name, name, key in cases:
+        case = etree.SubElement(suite, 'testcase', classname='reference.' + flat_name, name=name)
+        counts['tests'] += 1
+        if key is None:
+            etree.SubElement(case, 'skipped', message='marked <notest/>')
+            counts['skipped'] += 1
+            continue
+        result = checks.get(key)
+        if result is None:
+            etree.SubElement(case, 'error', message='never ran')
+            counts['errors'] += 1
+            continue
+        seconds = result.get('seconds') or 0
+        total += seconds
+        case.set('time', '{:.3f}'.format(seconds))
+        if result['status'] != 'success':
+            failure = etree.SubElement(case, 'failure', message=result.get('error', 'failed'))
+            failure.text = result.get('error', '')
+            counts['failures'] += 1
+    for name, count in counts.iteritems():
+        suite.set(name, str(count))
+    suite.set('time', '{:.3f}'.format(total))
+    root = etree.Element('testsuites')
+    root.append(suite)
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(etree.tostring(root, pretty_print=True, xml_declaration=True, encoding='UTF-8'))
+    return counts
+
+def check_examples(junit_path, jobs=1, render_server=None, timeout=default_image_timeout, javabin="java"):
+    '''
+    Run every example of the reference pages a build writes, without saving
+    images, and report how each went in a JUnit-style XML file at junit_path.
+    Examples whose code hasn't changed since they last ran aren't run again.
+    Returns the number of examples that failed.
+    '''
+    print_header("Checking examples")
+    items_dict = load_reference_items(reference_dir)
+    backend = JythonBackend(src_dir, "./processing-py.jar", javabin, jobs, render_server, timeout)
+    checks = ExampleChecks(os.path.join(cache_dir, 'example-checks.json'), backend.version())
+    work_dir = tempfile.mkdtemp(prefix='processing-py-site-check')
+    cases = []
+    workitems = {}
+    queued = set()
+    unchanged = 0
+    try:
+        for flat_name in sorted(published_reference_pages(items_dict)):
+            for number, example in enumerate(items_dict[flat_name].examples):
+                name = flat_name + str(number)
+                if not example.run:
+                    cases.append((flat_name, name, None))
+                    continue
+                key = checks.key(example.code)
+                cases.append((flat_name, name, key))
+                if checks.passed(key):
+                    unchanged += 1
+                    continue
+                # Examples with the same code only need to run once.
+                if key in queued:
+                    continue
+                queued.add(key)
+                workitems[name] = {
+                    'name': name,
+                    'key': key,
+                    'scriptfile': os.path.join(work_dir, name + '.py'),
+                    'imagefile': os.path.join(work_dir, name + '.png'), # Never written
+                    'example_code': example.code,
+                    'postlude': check_postlude,
+                }
+        print("{} example(s) to run; {} passed before and haven't changed.".format(len(workitems), unchanged))
+        if workitems:
+            backend.run(workitems, checks)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        checks.save(set(case[2] for case in cases))
+
+    counts = write_junit_report(junit_path, cases, checks)
+    for problem in checks.problems:
+        print_error(problem)
+    failed = [name for flat_name, name, key in cases if key is not None and not checks.passed(key)]
+    if failed:
+        print("Failed examples:")
+        for name in failed:
+            print("    ", name)
+    print("{tests} example(s): {failures} failed, {errors} never ran, {skipped} skipped.".format(**counts))
+    print("Wrote {}".format(junit_path))
     return len(failed)
 
+# Safe to call again on the same items (say, after their images are regenerated).
 def find_images(items_dict, to_update, img_dir):
     for name in to_update:
         item = items_dict[name]
         for number, example in enumerate(item.examples):
             example_filename = name + str(number) + '.png'
             example_path = os.path.join(img_dir, example_filename)
-            if example['image']:
+            example.image = None
+            example.size = None
+            example.broken = False
+            if example.wants_image:
                 if os.path.exists(example_path):
                     # UPDATE THIS if the image directory changes!
-                    example['image'] = canon_reference_dir + 'imgs/' + example_filename
+                    example.image = canon_reference_dir + 'imgs/' + example_filename
+                    example.size = image_size(example_path)
                 else:
                     # We want an image, but we don't have one. hm.
-                    del example['image']
-                    example['broken'] = True
+                    example.broken = True
             else:
                 if os.path.exists(example_path):
                     # So, we run all example sketches as a kind of unit-test, and they all save images,
@@ -259,60 +1260,953 @@ def find_images(items_dict, to_update, img_dir):
                     # images.
                     os.remove(example_path)
 
+def image_state(item, source):
+    '''What a page's example images are made from, when a backend with the given source makes them.'''
+    return {'source': source, 'keys': [image_key(example.code, source) for example in item.examples if example.run]}
+
+def missing_images(item, img_dir):
+    '''Whether an example on item's page that wants an image (and can be run to make one) is without one.'''
+    for number, example in enumerate(item.examples):
+        if example.run and example.wants_image:
+            if not os.path.exists(os.path.join(img_dir, item.flatname + str(number) + '.png')):
+                return True
+    return False
+
+def image_size(path):
+    '''The (width, height) of a PNG, JPEG or GIF, read from its header, or None if it isn't one.'''
+    with open(path, 'rb') as f:
+        header = f.read(26)
+        if header.startswith(png_signature) and header[12:16] == 'IHDR':
+            return struct.unpack('>II', header[16:24])
+        if header[:6] in ('GIF87a', 'GIF89a'):
+            return struct.unpack('<HH', header[6:10])
+        if not header.startswith('\xff\xd8'):
+            return None
+        # Walk the JPEG's segments to the start of its frame
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != '\xff':
+                return None
+            code = ord(marker[1])
+            if code in (0xd8, 0x01) or 0xd0 <= code <= 0xd7: # Segments without a length
+                continue
+            length = struct.unpack('>H', f.read(2))[0]
+            if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+                height, width = struct.unpack('>xHH', f.read(5))
+                return width, height
+            f.seek(length - 2, os.SEEK_CUR)
+
+png_signature = '\x89PNG\r\n\x1a\n'
+
+def png_chunks(data):
+    '''The (type, body) of each chunk of a PNG.'''
+    position = len(png_signature)
+    while position < len(data):
+        length, = struct.unpack('>I', data[position:position + 4])
+        yield data[position + 4:position + 8], data[position + 8:position + 8 + length]
+        position += length + 12
+
+def png_chunk(chunk_type, body):
+    return struct.pack('>I', len(body)) + chunk_type + body + struct.pack('>I', zlib.crc32(chunk_type + body) & 0xffffffff)
+
+# Ancillary PNG chunks that don't affect how the image looks
+png_metadata_chunks = ('tEXt', 'zTXt', 'iTXt', 'tIME')
+
+def recompress_png(data):
+    '''
+    Losslessly shrink a PNG by compressing its image data as hard as zlib can
+    and dropping text and timestamps. The pixels, and the filters they're
+    stored with, are untouched. Returns data itself if that's no smaller.
+    '''
+    chunks = list(png_chunks(data))
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9)
+    pixels = zlib.decompress(''.join(body for chunk_type, body in chunks if chunk_type == 'IDAT'))
+    image_data = compressor.compress(pixels) + compressor.flush()
+    out = [png_signature]
+    for chunk_type, body in chunks:
+        if chunk_type == 'IDAT':
+            if image_data is not None:
+                out.append(png_chunk('IDAT', image_data))
+                image_data = None
+        elif chunk_type not in png_metadata_chunks:
+            out.append(png_chunk(chunk_type, body))
+    result = ''.join(out)
+    return result if len(result) < len(data) else data
+
+class ImageOptimizer(object):
+    '''
+    Losslessly recompresses the PNGs and JPEGs in generated/, with optipng and
+    jpegtran where they're installed (and, for PNGs, recompress_png where not).
+    Results are cached under a hash of the original image, so no image is
+    optimized twice, and the size and mtime of each optimized file are
+    recorded, so that files that haven't changed since aren't even read.
+    '''
+    version = 1
+    extensions = ('.png', '.jpg', '.jpeg')
+
+    def __init__(self, cache_dir):
+        self.dir = os.path.join(cache_dir, 'optimized-images')
+        self.index_path = os.path.join(self.dir, 'index.json')
+        self.files = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.files = json.load(f)['files']
+        self.optipng = distutils.spawn.find_executable('optipng')
+        self.jpegtran = distutils.spawn.find_executable('jpegtran')
+        # The tools we have go into the key, so installing one redoes everything.
+        self.tools = '{}:{}:{}'.format(self.version, bool(self.optipng), bool(self.jpegtran))
+
+    def optimized(self, data, extension):
+        '''The optimized version of an image's data.'''
+        if extension == '.png':
+            if self.optipng:
+                return self.run_tool(data, extension, [self.optipng, '-quiet', '-o2', '-out', '{out}', '{in}'])
+            return recompress_png(data)
+        if self.jpegtran:
+            return self.run_tool(data, extension, [self.jpegtran, '-copy', 'none', '-optimize', '-outfile', '{out}', '{in}'])
+        return data
+
+    def run_tool(self, data, extension, cmd):
+        in_fd, in_path = tempfile.mkstemp(suffix=extension, dir=self.dir)
+        out_path = in_path[:-len(extension)] + '-out' + extension
+        try:
+            with os.fdopen(in_fd, 'wb') as f:
+                f.write(data)
+            with open(os.devnull, 'w') as devnull:
+                returncode = subprocess.call([arg.format(**{'in': in_path, 'out': out_path}) for arg in cmd],
+                        stdout=devnull, stderr=subprocess.STDOUT)
+            if returncode != 0 or not os.path.exists(out_path):
+                return data
+            with open(out_path, 'rb') as f:
+                result = f.read()
+            return result if len(result) < len(data) else data
+        finally:
+            for path in (in_path, out_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def optimize(self, path):
+        '''
+        Replace the image at path with its optimized version, returning its
+        original size, its new size and the cache key. The file is replaced by
+        renaming, so that anything it's hard-linked to (its source, say) is
+        left alone.
+        '''
+        extension = os.path.splitext(path)[1].lower()
+        with open(path, 'rb') as f:
+            data = f.read()
+        key = hashlib.sha1(self.tools + '\0' + data).hexdigest()
+        cached_path = os.path.join(self.dir, key + extension)
+        if not os.path.exists(cached_path):
+            try:
+                result = self.optimized(data, extension)
+            except Exception as e: # A broken image; leave it be
+                with print_lock:
+                    print_warning("Couldn't optimize {}: {}".format(path, e))
+                result = data
+            # Identical images may be optimized at once, so each gets its own temporary file.
+            fd, temp_path = tempfile.mkstemp(dir=self.dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(result)
+            os.rename(temp_path, cached_path)
+        size = os.path.getsize(cached_path)
+        if size != len(data):
+            temp_path = path + '.tmp'
+            link_or_copy(cached_path, temp_path)
+            os.rename(temp_path, path)
+        return len(data), size, key
+
+    def run(self, roots, jobs=1):
+        '''Optimize the images under roots that have changed since they were last optimized.'''
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        files = {}
+        todo = []
+        for root in roots:
+            for dirpath, dirnames, filenames in os.walk(root):
+                for filename in filenames:
+                    if not filename.lower().endswith(self.extensions):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    rel_path = os.path.relpath(path, target_dir)
+                    entry = self.files.get(rel_path)
+                    if entry and entry[:2] == file_stamp(path):
+                        files[rel_path] = entry
+                    else:
+                        todo.append((rel_path, path))
+        pool = multiprocessing.pool.ThreadPool(max(1, jobs))
+        try:
+            results = pool.map(lambda (rel_path, path): self.optimize(path), todo)
+        finally:
+            pool.close()
+            pool.join()
+        before = after = 0
+        for (rel_path, path), (old_size, new_size, key) in zip(todo, results):
+            files[rel_path] = file_stamp(path) + [key]
+            before += old_size
+            after += new_size
+        self.files = files
+        return len(todo), before - after
+
+    def prune(self):
+        '''Delete cached results that no file uses any more.'''
+        used = set(entry[2] for entry in self.files.itervalues())
+        for filename in os.listdir(self.dir):
+            key, extension = os.path.splitext(filename)
+            if extension in self.extensions and key not in used:
+                os.remove(os.path.join(self.dir, filename))
+
+    def save(self):
+        write_json(self.index_path, {'files': self.files})
+
+def optimize_images(jobs=1):
+    '''Optimize the example images and tutorial images in generated/.'''
+    print('Optimizing images... ', end='')
+    optimizer = ImageOptimizer(cache_dir)
+    count, saved = optimizer.run([os.path.join(target_reference_dir, 'imgs'), target_tutorials_dir], jobs)
+    optimizer.prune()
+    optimizer.save()
+    print_success('{} image(s) optimized, {:.1f} KB saved.'.format(count, saved / 1024))
+
+compressible_extensions = ('.html', '.css', '.js', '.json', '.svg', '.xml', '.txt')
+compressed_suffixes = ('.gz', '.br')
+
+def gzip_data(data):
+    '''Gzip data, leaving out the timestamp and filename so the same input always gives the same output.'''
+    out = StringIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=out, compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return out.getvalue()
+
+def remove_compressed(path):
+    '''
+    Remove path's .gz and .br siblings, once path has changed or gone, so
+    that a server that prefers them never sends the old content.
+    '''
+    for suffix in compressed_suffixes:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def compress_file(path):
+    '''Write path's .gz (and .br) siblings, removing any that would be no smaller than path itself.'''
+    with open(path, 'rb') as f:
+        data = f.read()
+    encoders = [('.gz', gzip_data)]
+    if brotli:
+        encoders.append(('.br', brotli.compress))
+    for suffix, encode in encoders:
+        compressed = encode(data)
+        if len(compressed) < len(data):
+            write_file(path + suffix, compressed)
+        elif os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+class OutputManifest(object):
+    '''
+    The SHA-1 and size of every file in generated/, written out as
+    generated/manifest.json so that deploys can compare it with the last one
+    and upload only what has changed. Hashes are kept in the cache along with
+    the size and mtime they were computed for, so only files that have
+    changed are read again.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.brotli = None
+        if os.path.exists(path):
+            with open(path) as f:
+                index = json.load(f)
+            self.files, self.brotli = index['files'], index['brotli']
+
+    def scan(self):
+        '''
+        Hash every file in generated/ (but the manifest), returning the paths
+        (relative to generated/) of those that are new or have changed.
+        '''
+        files = {}
+        changed = []
+        for dirpath, dirnames, filenames in os.walk(target_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                rel_path = os.path.relpath(path, target_dir)
+                if rel_path == 'manifest.json':
+                    continue
+                entry = self.files.get(rel_path)
+                files[rel_path] = file_digest(path, entry)
+                if not entry or entry[2] != files[rel_path][2]:
+                    changed.append(rel_path)
+        self.files = files
+        return changed
+
+    def save(self):
+        write_json(self.path, {'files': self.files, 'brotli': self.brotli})
+        manifest = dict((rel_path, {'sha1': entry[2], 'size': entry[0]})
+                for rel_path, entry in self.files.iteritems())
+        write_json(os.path.join(target_dir, 'manifest.json'), {'files': manifest})
+
+def compress_outputs(jobs=1):
+    '''
+    Write gzipped (and, with the brotli module, Brotli-compressed) copies of
+    the text files in generated/ alongside them, for servers that can send
+    them as they are, and update the manifest. Files whose content hasn't
+    changed since the last build aren't compressed again.
+    '''
+    print('Compressing pages and resources... ', end='')
+    manifest = output_manifest()
+    changed = set(manifest.scan())
+    todo = []
+    for rel_path in manifest.files:
+        path = os.path.join(target_dir, rel_path)
+        base, extension = os.path.splitext(rel_path)
+        if extension in compressed_suffixes:
+            # Left over from a file that's gone, or can't be compressed any more
+            if base not in manifest.files or not base.endswith(compressible_extensions):
+                os.remove(path)
+            continue
+        if not rel_path.endswith(compressible_extensions):
+            continue
+        if (rel_path in changed or manifest.brotli != bool(brotli) or
+                not any(rel_path + suffix in manifest.files for suffix in compressed_suffixes)):
+            todo.append(path)
+    pool = multiprocessing.pool.ThreadPool(max(1, jobs))
+    try:
+        pool.map(compress_file, todo)
+    finally:
+        pool.close()
+        pool.join()
+    # Take note of the compressed files (and of the ones removed)
+    manifest.scan()
+    manifest.brotli = bool(brotli)
+    manifest.save()
+    print_success('{} file(s) compressed{}.'.format(len(todo), '' if brotli else ' (gzip only; brotli is not installed)'))
+
+def output_manifest():
+    return OutputManifest(os.path.join(cache_dir, 'output-hashes.json'))
+
+def refresh_manifest():
+    '''
+    Bring generated/manifest.json up to date after a build without
+    --compress, so that it never describes files as they were. Files whose
+    compressed copies were removed are compressed again by the next build
+    with --compress.
+    '''
+    manifest = output_manifest()
+    manifest.scan()
+    manifest.save()
+
+def element_key(element):
+    '''Identify an element from our source XML by the file it came from and its path in that file.'''
+    tree = element.getroottree()
+    return tree.docinfo.URL, tree.getpath(element)
+
+def escape_attribute(value):
+    return escape_text(value).replace('"', '&quot;')
+
 def make_convert_hypertext(names_dict):
     """
-    Create a function to convert etree.Elements from our source xml into properly-formatted HTML.
-    The function is used directly from jinja.
+    Create a function to convert XMLFragments (or etree.Elements) from our source xml into
+    properly-formatted HTML. The function is used directly from jinja. It never modifies the
+    elements it's given, and it remembers what it made of each one (by element_key, or a fragment's
+    url), so that each is only converted, or even parsed, once. Elements that weren't parsed
+    from a file can't be told apart that way, and are converted every time.
     """
-    def convert_hypertext(element, _toplevel=True):
+    converted = {}
+
+    def child_html(element):
+        '''Serialize element and its tail as HTML, turning <ref>s into links and <c>s into <kbd>s.'''
+        if not isinstance(element.tag, basestring) or next(element.iter('ref', 'c'), None) is None:
+            # Nothing of ours in here (or it's a comment): lxml can serialize it as it is.
+            return lxml.html.tostring(element, encoding=unicode)
+        tag = element.tag
+        attributes = dict(element.attrib)
+        text = escape_text(element.text or '')
+        if tag == 'ref':
+            target = ref_target(element)
+            tag = 'a'
+            attributes = {'href': create_ref_link(target)}
+            if not element.get('target') and target in names_dict:
+                # <ref>name</ref> is shown as the proper name of the page it links to.
+                # A ref to a page that doesn't exist keeps its text; the link check reports it.
+                text = escape_text(names_dict[target].name)
+        elif tag == 'c':
+            tag = 'kbd'
+        start = '<' + tag + ''.join(' {}="{}"'.format(name, escape_attribute(value))
+                for name, value in sorted(attributes.iteritems())) + '>'
+        children = ''.join(child_html(child) for child in element)
+        return start + text + children + '</' + tag + '>' + escape_text(element.tail or '')
+
+    def convert_hypertext(element):
         if element is None:
             return ''
-            
-        if _toplevel:
-            element = copy.deepcopy(element)
-            text = element.text if hasattr(element, 'text') and element.text else ''
-
-        if hasattr(element, 'tag') and element.tag == 'ref':
-            element.tag = 'a'
-            name = names_dict[target] # Look up the proper name for this page in the names dictionary
-            element.attib['href'] = create_ref_link(target)
-            element.text = name
-        elif hasattr(element, 'tag') and element.tag == 'c':
-            element.tag = 'kbd'
-
-        for child in element:
-            convert_hypertext(child, _toplevel=False)
-            if _toplevel:
-                # We don't just do this at the top level because we need to skip the top-level tags
-                s = lxml.html.tostring(child)
-                if s:
-                    text += s
-
-        if _toplevel:
-            return text
-
+        if isinstance(element, XMLFragment):
+            key = element.url
+            if key in converted:
+                return converted[key]
+            element = element.element()
+        else:
+            key = element_key(element)
+            if key[0] is None:
+                # Not from a file, so nothing tells it apart from another such element.
+                key = None
+        if key in converted:
+            return converted[key]
+        # The top-level tag itself is skipped; its text is already HTML.
+        html = (element.text or '') + ''.join(child_html(child) for child in element)
+        result = jinja2.Markup(clean_fragment(html))
+        if key is not None:
+            converted[key] = result
+        return result
+
+    # For builds that share an environment (as in `watch`), so that each one
+    # converts elements afresh without the templates' globals being replaced.
+    convert_hypertext.forget = converted.clear
     return convert_hypertext
 
+# Pages used to be cleaned by parsing the whole rendered page with lxml.html
+# and serializing it again. Instead, the templates are written in the
+# normalized form lxml would have serialized them in, and the values
+# substituted into them are normalized on their way in: escape_text takes care
+# of plain values, and clean_fragment of the HTML that convert_hypertext
+# produces. That leaves clean_html with nothing to do but make the page
+# ASCII-safe.
+
+def escape_text(value):
+    '''
+    Escape a value substituted into a template, the way lxml would serialize
+    it as text. Values that are already markup are left alone. This is the
+    finalize function of the template environment.
+    '''
+    if value is None or hasattr(value, '__html__'):
+        return value
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    if '&' in value or '<' in value or '>' in value:
+        value = value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return value
+
+def clean_fragment(html):
+    '''Normalize a fragment of HTML, as parsing and serializing the page around it would.'''
+    if '<' not in html and '&' not in html and '>' not in html:
+        return html # Plain text; there's nothing to normalize
+    fragments = lxml.html.fragments_fromstring(html)
+    # lxml drops leading text that's only whitespace, which matters in a <pre>
+    text = html[:len(html) - len(html.lstrip())]
+    if fragments and isinstance(fragments[0], basestring):
+        text = escape_text(fragments.pop(0))
+    return text + ''.join(lxml.html.tostring(fragment, encoding=unicode) for fragment in fragments)
+
 def clean_html(html):
-    html_tree = lxml.html.fromstring(html)
-    return lxml.html.tostring(html_tree, encoding='ascii')
+    '''Turn a rendered page into the bytes we write out.'''
+    return html.encode('ascii', 'xmlcharrefreplace')
+
+def ref_target(element):
+    '''The flat name a <ref> element points at: its target attribute, or else its text.'''
+    target = (element.get('target') or element.text or '').strip()
+    if target.endswith('.xml'):
+        target = target[:-4]
+    return target
 
 def create_ref_link(name):
     return canon_reference_dir + name + '.html' # We might change this later
 
-def build_reference(reference_dir, to_update, env, build_images):
+def ref_link_target(url):
+    '''The flat name a link made by create_ref_link points at, or None if url isn't one.'''
+    if url.startswith(canon_reference_dir) and url.endswith('.html'):
+        return url[len(canon_reference_dir):-len('.html')]
+    return None
+
+def load_reference_items(reference_dir):
+    '''
+    Parse the reference into a dictionary from flat names to ReferenceItems.
+    The parsed items' states are pickled into the cache, so that later builds
+    only parse the files whose mtime or size has changed since.
+    '''
+    print('Loading reference items')
+    index_path = os.path.join(cache_dir, 'reference-items.pickle')
+    cached = {}
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'rb') as f:
+                index = pickle.load(f)
+            if index['version'] == ReferenceItem.cache_version:
+                cached = index['items']
+        except Exception as e:
+            print_warning("Ignoring unreadable {}: {}".format(index_path, e))
+
+    items_dict = {}
+    entries = {}
+    parsed = 0
+    for filename in sorted(os.listdir(reference_dir)):
+        if not filename.endswith('.xml'):
+            continue
+        source_file_path = os.path.join(reference_dir, filename)
+        stat = os.stat(source_file_path)
+        stamp = (stat.st_mtime, stat.st_size)
+        if filename in cached and cached[filename][0] == stamp:
+            state = cached[filename][1]
+            item = ReferenceItem.from_state(state)
+        else:
+            item = ReferenceItem(source_file_path)
+            state = item.__getstate__()
+            parsed += 1
+        entries[filename] = (stamp, state)
+        items_dict[item.flatname] = item
+
+    # Write the cache now, before anything in the build starts changing items.
+    if parsed or len(entries) != len(cached):
+        write_file(index_path, pickle.dumps({'version': ReferenceItem.cache_version, 'items': entries},
+                pickle.HIGHEST_PROTOCOL))
+
+    items_dict[''] = items_dict['blank'] # Special case, for blank links
+    print_success('{} of {} files parsed.'.format(parsed, len(entries)))
+    return items_dict
+
+def template_files(env, name):
+    '''Paths of the template called name and of every template it extends or includes.'''
+    source, filename, _ = env.loader.get_source(env, name)
+    files = [os.path.normpath(filename)]
+    for referenced in jinja2.meta.find_referenced_templates(env.parse(source)):
+        if referenced is not None:
+            files.extend(f for f in template_files(env, referenced) if f not in files)
+    return files
+
+class DependencyGraph(object):
+    '''
+    Records what each reference page was built from: the files it depends on
+    (its source and its templates) and the display names of the pages it
+    links to, the pages it has the browser prefetch, and what its example
+    images were made from (see image_state). Kept between builds,
+    so that an incremental build can rebuild exactly the pages that are stale.
+    A page that links to another only cares about that page's name, so editing
+    a description rebuilds just one page.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.pages = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.pages = json.load(f)['pages']
+        self.mtimes = {}
+
+    def mtime(self, path):
+        if path not in self.mtimes:
+            self.mtimes[path] = os.path.getmtime(path) if os.path.exists(path) else None
+        return self.mtimes[path]
+
+    def record(self, item, template_paths, items_dict, built, prefetch, images=None):
+        '''
+        Record what a page was built from, as of the time built. images is its
+        image_state if its images were just generated; if not, its images are
+        what they were, and so is their record.
+        '''
+        if images is None:
+            images = self.pages.get(item.flatname, {}).get('images')
+        names = {}
+        for name in item.linked_names():
+            names[name] = items_dict[name].name if name in items_dict else None
+        self.pages[item.flatname] = {
+            'files': [os.path.normpath(item.source_xml)] + template_paths,
+            'names': names,
+            'built': built,
+            'prefetch': prefetch,
+            'images': images,
+        }
+
+    # When a page was built is recorded, rather than taken from its mtime,
+    # because a page that comes out the same isn't written again.
+    # images is the page's image_state when images are being generated, and
+    # None when they aren't (and so don't make a page stale).
+    def is_stale(self, flat_name, target_file_path, items_dict, prefetch, images=None):
+        if flat_name not in self.pages or not os.path.exists(target_file_path):
+            return True
+        page = self.pages[flat_name]
+        built = page.get('built')
+        if built is None or page.get('prefetch') != prefetch:
+            return True
+        if images is not None and page.get('images') != images:
+            return True
+        for path in page['files']:
+            mtime = self.mtime(path)
+            if mtime is None or mtime > built:
+                return True
+        for name, display_name in page['names'].iteritems():
+            current = items_dict[name].name if name in items_dict else None
+            if current != display_name:
+                return True
+        return False
+
+    def prune(self, flat_names):
+        for flat_name in list(self.pages):
+            if flat_name not in flat_names:
+                del self.pages[flat_name]
+
+    def save(self):
+        write_json(self.path, {'pages': self.pages})
+
+def reference_dependency_graph():
+    return DependencyGraph(os.path.join(cache_dir, 'reference-dependencies.json'))
+
+def remove_unpublished_pages(items_dict):
+    '''
+    Remove the reference pages of items that are gone or are no longer
+    published (see to_skip_patterns), with their example images where we
+    know them, and forget what those pages were built from. Returns how many
+    pages were removed.
+    '''
+    pages = published_reference_pages(items_dict)
+    removed = []
+    if os.path.isdir(target_reference_dir):
+        for filename in sorted(os.listdir(target_reference_dir)):
+            flat_name = filename[:-len('.html')]
+            if filename.endswith('.html') and filename != 'index.html' and flat_name not in pages:
+                removed.append(os.path.join(target_reference_dir, filename))
+                if flat_name in items_dict:
+                    for number in range(len(items_dict[flat_name].examples)):
+                        removed.append(os.path.join(target_reference_dir, 'imgs', flat_name + str(number) + '.png'))
+    for path in removed:
+        if os.path.exists(path):
+            os.remove(path)
+        remove_compressed(path)
+    graph = reference_dependency_graph()
+    if set(graph.pages) - pages:
+        graph.prune(pages)
+        graph.save()
+    return sum(1 for path in removed if path.endswith('.html'))
+
+def find_stale_pages(items_dict, backend=None):
+    '''
+    Flat names of the reference pages that need to be rebuilt. When images
+    are being generated with backend, that includes the pages whose images
+    were made from something else, or are missing (so failed examples are
+    tried again).
+    '''
+    graph = reference_dependency_graph()
+    prefetches = reference_prefetches(items_dict)
+    img_dir = os.path.join(target_reference_dir, 'imgs')
+    source = backend.source() if backend is not None else None
+    stale = []
+    for flat_name in sorted(published_reference_pages(items_dict)):
+        target_file_path = os.path.join(target_reference_dir, flat_name + '.html')
+        images = None
+        if backend is not None:
+            images = image_state(items_dict[flat_name], source)
+            if missing_images(items_dict[flat_name], img_dir):
+                stale.append(flat_name)
+                continue
+        if graph.is_stale(flat_name, target_file_path, items_dict, prefetches[flat_name], images):
+            stale.append(flat_name)
+    return stale
+
+class AssetSync(object):
+    '''
+    Keeps directories of static files (content/, each tutorial's imgs/)
+    mirrored into generated/. The size and mtime of every file's source are
+    recorded when it's copied, and a file is copied again only when those
+    change, or when its copy is gone. Files are hard-linked where possible.
+    Files whose source has disappeared are removed, but only files that a
+    sync put there; nothing else in generated/ is touched.
+    '''
+    def __init__(self, path):
+        self.path = path
+        # Target directory (relative to generated/) -> file (relative to
+        # that directory) -> [size, mtime] of its source
+        self.trees = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.trees = json.load(f)['trees']
+        self.synced = set()
+
+    def sync(self, src_root, dst_root):
+        '''Bring dst_root up to date with src_root, returning the number of files copied and removed.'''
+        tree_name = os.path.relpath(dst_root, target_dir)
+        old_files = self.trees.get(tree_name, {})
+        files = {}
+        copied = 0
+        for dirpath, dirnames, filenames in os.walk(src_root):
+            for filename in filenames:
+                src = os.path.join(dirpath, filename)
+                rel_path = os.path.relpath(src, src_root)
+                dst = os.path.join(dst_root, rel_path)
+                files[rel_path] = file_stamp(src)
+                if old_files.get(rel_path) == files[rel_path] and os.path.exists(dst):
+                    continue
+                if not os.path.exists(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                link_or_copy(src, dst)
+                remove_compressed(dst)
+                copied += 1
+        removed = 0
+        for rel_path in old_files:
+            if rel_path not in files:
+                self.remove(dst_root, rel_path)
+                removed += 1
+        self.trees[tree_name] = files
+        self.synced.add(tree_name)
+        return copied, removed
+
+    def remove(self, dst_root, rel_path):
+        '''Remove a synced file, and any directories that leaves empty.'''
+        path = os.path.join(dst_root, rel_path)
+        if os.path.lexists(path):
+            os.remove(path)
+        remove_compressed(path)
+        directory = os.path.dirname(path)
+        while os.path.normpath(directory) != os.path.normpath(dst_root):
+            if not os.path.isdir(directory) or os.listdir(directory):
+                break
+            os.rmdir(directory)
+            directory = os.path.dirname(directory)
+
+    def keep(self, dst_root):
+        '''Count dst_root as synced this build without looking at it (its source hasn't changed).'''
+        tree_name = os.path.relpath(dst_root, target_dir)
+        if tree_name in self.trees:
+            self.synced.add(tree_name)
+
+    def prune(self):
+        '''Remove the files of trees that weren't synced this build (e.g. deleted tutorials).'''
+        removed = 0
+        for tree_name in list(self.trees):
+            if tree_name not in self.synced:
+                dst_root = os.path.join(target_dir, tree_name)
+                for rel_path in self.trees.pop(tree_name):
+                    self.remove(dst_root, rel_path)
+                    removed += 1
+                if os.path.isdir(dst_root) and not os.listdir(dst_root):
+                    os.rmdir(dst_root)
+        return removed
+
+    def save(self):
+        write_json(self.path, {'trees': self.trees})
+
+def asset_sync():
+    return AssetSync(os.path.join(cache_dir, 'assets.json'))
+
+def make_environment(template_dir, items_dict, auto_reload=False):
+    '''
+    Create the Jinja environment that pages are rendered with. Compiled
+    templates are kept in the cache, so they're only compiled again when they
+    change. A batch build loads each template once; pass auto_reload to have
+    templates checked for changes whenever they're used.
+    '''
+    bytecode_dir = os.path.join(cache_dir, 'templates')
+    try:
+        os.makedirs(bytecode_dir)
+    except OSError: # Already there (perhaps made by another render worker)
+        pass
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir), trim_blocks='true',
+            finalize=escape_text, auto_reload=auto_reload,
+            bytecode_cache=jinja2.FileSystemBytecodeCache(bytecode_dir))
+    # Every global is in place before any template is loaded, and none is
+    # replaced afterwards.
+    env.globals['items_dict'] = items_dict
+    env.globals['convert_hypertext'] = make_convert_hypertext(items_dict)
+    env.globals['create_ref_link'] = create_ref_link
+    env.globals['hasattr'] = hasattr
+    return env
+
+# Pages are rendered by functions that take a single task argument, so that
+# they can be run in a pool of worker processes. Each worker has its own copy
+# of the template environment (and the reference it was created with).
+render_worker = {}
+
+def init_render_worker(template_dir, items_dict, auto_reload):
+    render_worker['env'] = make_environment(template_dir, items_dict, auto_reload)
+
+def render_pages(render_page, tasks, env, jobs=1):
+    '''
+    Call render_page on each task, yielding the results in order. With more
+    than one job, the pages are rendered in that many worker processes, which
+    set up environments of their own like env.
+    '''
+    if jobs <= 1 or len(tasks) <= 1:
+        render_worker['env'] = env
+        for task in tasks:
+            yield render_page(task)
+        return
+    template_dir = env.loader.searchpath[0]
+    pool = multiprocessing.Pool(jobs, init_render_worker, (template_dir, env.globals['items_dict'], env.auto_reload))
+    try:
+        chunksize = max(1, len(tasks) // (jobs * 4))
+        for result in pool.imap(render_page, tasks, chunksize):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def render_reference_page(task):
+    flat_name, today, prefetch = task
+    env = render_worker['env']
+    target_file_path = os.path.join(target_reference_dir, flat_name + '.html')
+    source_item = env.globals['items_dict'][flat_name]
+    start = time.time()
+    rendered = env.get_template("reference_item_template.jinja").render(item=source_item, today=today,
+            prefetch=[create_ref_link(name) for name in prefetch])
+    rendered_time = time.time()
+    cleaned = clean_html(rendered)
+    timings = {'render': rendered_time - start, 'clean': time.time() - rendered_time}
+    return flat_name, timings, write_if_changed(target_file_path, cleaned)
+
+# Where the site is served from; links to it from the tutorials are checked
+# like links within the site.
+site_url = 'http://py.processing.org'
+
+# A <ref> that a CDATA section has turned into plain text
+raw_ref_pattern = re.compile(r'<ref\b[^>]*>')
+
+def published_reference_pages(flat_names):
+    '''
+    Those of flat_names (or of the keys of a dictionary of items) whose
+    reference pages a build writes.
+    '''
+    return set(flat_name for flat_name in flat_names if flat_name != '' and
+            not any(re.search(patt, flat_name) for patt in to_skip_patterns))
+
+def tutorial_folders():
+    '''The folders of the tutorials listed in tutorials.xml, in order.'''
+    index_data = etree.parse(os.path.join(tutorials_dir, 'tutorials.xml'))
+    return [tutorial_element.text for tutorial_element in index_data.iterfind('tutorial')]
+
+def reference_link_problem(flat_name, pages, items_dict):
+    '''What's wrong with a link to the reference page flat_name, or None.'''
+    if flat_name in pages or (flat_name == '' and 'blank' in pages):
+        return None
+    if flat_name in items_dict:
+        return "isn't built (it matches to_skip_patterns)"
+    return "doesn't exist"
+
+def check_reference_links(items_dict, pages):
+    '''
+    Check the links on each reference page: related pages, method refs,
+    <ref>s in the text, and <ref>s that a CDATA section has left as text.
+    Returns a list of (source file, link, problem).
+    '''
+    problems = []
+    for flat_name in sorted(pages):
+        item = items_dict[flat_name]
+        links = [('related', related) for related in item.relateds]
+        for method in item.methods:
+            target = ref_link_target(method.ref)
+            if target is not None:
+                links.append(('method ref', target))
+        for element in item.hypertext_elements():
+            for ref in element.iter('ref'):
+                links.append(('<ref>', ref_target(ref)))
+            for text in element.itertext():
+                if '<ref' in text:
+                    for match in raw_ref_pattern.finditer(text):
+                        problems.append((item.source_xml, match.group(0),
+                            'is inside CDATA, so it is shown as text rather than made a link'))
+        for kind, target in links:
+            problem = reference_link_problem(target, pages, items_dict)
+            if problem:
+                problems.append((item.source_xml, '{} {}'.format(kind, target), problem))
+    return problems
+
+def site_link_problem(path, pages, items_dict, folders):
+    '''What's wrong with a link to path on the site, or None if it's fine (or not ours to check).'''
+    if path.startswith(canon_reference_dir):
+        rest = path[len(canon_reference_dir):]
+        if rest in ('', 'index.html') or rest.startswith('imgs/') or rest.startswith('search/'):
+            return None
+        if not rest.endswith('.html') or '/' in rest:
+            return "isn't a reference page"
+        return reference_link_problem(rest[:-len('.html')], pages, items_dict)
+    if path.startswith(canon_tutorials_dir):
+        parts = path[len(canon_tutorials_dir):].split('/', 1)
+        if parts[0] in ('', 'index.html'):
+            return None
+        if parts[0] not in folders:
+            return "isn't a tutorial"
+        rest = parts[1] if len(parts) > 1 else ''
+        if rest in ('', 'index.html'):
+            return None
+        if rest.startswith('imgs/') and os.path.isfile(os.path.join(tutorials_dir, parts[0], rest)):
+            return None
+        return "isn't published with the tutorial"
+    return None
+
+def check_tutorial_links(folders, pages, items_dict):
+    '''
+    Check the links and images in each tutorial that point into the
+    reference or the tutorials, including absolute links to site_url.
+    Returns a list of (source file, link, problem).
+    '''
+    problems = []
+    folder_set = set(folders)
+    for folder in folders:
+        source = os.path.join(tutorials_dir, folder, 'index.html')
+        base = site_url + canon_tutorials_dir + folder + '/'
+        for element, attribute, link, _ in lxml.html.parse(source).getroot().iterlinks():
+            if (element.tag, attribute) not in (('a', 'href'), ('img', 'src')):
+                continue
+            url = urlparse.urlsplit(urlparse.urljoin(base, link.strip()))
+            if url.scheme not in ('http', 'https') or url.netloc != urlparse.urlsplit(site_url).netloc:
+                continue
+            problem = site_link_problem(url.path, pages, items_dict, folder_set)
+            if problem:
+                problems.append((source, link, problem))
+    return problems
+
+def check_links(items_dict):
+    '''
+    Find every dangling link between the pages of the site, without rendering
+    anything. Returns a list of (source file, link, problem).
+    '''
+    pages = published_reference_pages(items_dict)
+    return (check_reference_links(items_dict, pages) +
+            check_tutorial_links(tutorial_folders(), pages, items_dict))
+
+def report_links(items_dict):
+    '''Warn about every dangling link, returning how many there are.'''
+    print('Checking links')
+    problems = check_links(items_dict)
+    for source, link, problem in problems:
+        print_warning('{}: {} {}'.format(source, link, problem))
+    if problems:
+        print_warning('{} dangling link(s)'.format(len(problems)))
+    else:
+        print_success('No dangling links.')
+    return len(problems)
+
+# How many pages a reference page has the browser prefetch
+prefetch_limit = 3
+
+def reference_prefetches(items_dict, limit=prefetch_limit):
+    '''
+    The pages each reference page has the browser prefetch, as a dictionary
+    from flat name to a list of flat names: of the pages in its relateds and
+    methods, the limit that the most reference pages link to, since those are
+    the ones a reader is likeliest to go on to.
+    '''
+    pages = published_reference_pages(items_dict)
+    candidates = {}
+    incoming = dict((flat_name, 0) for flat_name in pages)
+    for flat_name in pages:
+        item = items_dict[flat_name]
+        targets = item.relateds + [ref_link_target(method.ref) for method in item.methods]
+        candidates[flat_name] = []
+        for target in targets:
+            if target in pages and target != flat_name and target not in candidates[flat_name]:
+                candidates[flat_name].append(target)
+        for target in item.linked_names() | set(targets):
+            if target in pages and target != flat_name:
+                incoming[target] += 1
+    prefetches = {}
+    for flat_name, targets in candidates.iteritems():
+        # Sorting is stable, so ties keep the order of the source.
+        prefetches[flat_name] = sorted(targets, key=lambda target: -incoming[target])[:limit]
+    return prefetches
+
+# Images are generated with backend, a RenderBackend, unless it's None.
+# Pages say they were updated at today, if it isn't None (see build_timestamp).
+def build_reference(items_dict, to_update, env, backend=None, jobs=1, today=None):
     print('Building reference')
     if not to_update:
         print_success('Nothing to do.')
         return 0 
     failures = 0
-    # Dictionary from flat names to ReferenceItems
-    items_dict = {}
-    for filename in os.listdir(reference_dir):
-        if not filename.endswith('.xml'):
-            continue
-        items_dict[filename[:-4]] = ReferenceItem(os.path.join(reference_dir, filename))
-    items_dict[''] = items_dict['blank'] # Special case, for blank links
 
     print_success('{} stale files to be updated'.format(len(to_update)))
 
@@ -322,39 +2216,44 @@ def build_reference(reference_dir, to_update, env, build_images):
     if not os.path.exists(target_img_dir):
         os.makedirs(target_img_dir)
 
-    if build_images:
-        failures += generate_images(items_dict, to_update, src_dir, "./processing-py.jar", target_img_dir)
+    if backend is not None:
+        with build_profile.phase('generate images'):
+            failures += generate_images(items_dict, to_update, backend, target_img_dir)
     find_images(items_dict, to_update, target_img_dir)
 
-    reference_template = env.get_template("reference_item_template.jinja")
-    convert_hypertext = make_convert_hypertext(items_dict)
-
-    env.globals['items_dict'] = items_dict
-    env.globals['convert_hypertext'] = convert_hypertext
-    env.globals['create_ref_link'] = create_ref_link
-    env.globals['hasattr'] = hasattr
-
+    prefetches = reference_prefetches(items_dict)
+    tasks = [(flat_name, today, prefetches.get(flat_name, [])) for flat_name in to_update]
+    # Anything changed after this point is newer than the pages built from it.
+    built = time.time()
+    changed = 0
+    with build_profile.phase('render reference pages'):
+        for flat_name, timings, written in render_pages(render_reference_page, tasks, env, jobs):
+            build_profile.page(flat_name, timings)
+            changed += written
+            source_file_path = os.path.join(reference_dir, flat_name + '.xml')
+            target_file_path = os.path.join(target_reference_dir, flat_name + '.html')
+            print("Rendering {} to {}... ".format(source_file_path, target_file_path), end='')
+            print_success('success!' if written else 'unchanged.')
+    print('{} of {} page(s) changed.'.format(changed, len(to_update)))
+
+    graph = reference_dependency_graph()
+    template_paths = template_files(env, "reference_item_template.jinja")
+    source = backend.source() if backend is not None else None
     for flat_name in to_update:
-        source_file_path = os.path.join(reference_dir, flat_name + '.xml')
-        target_file_path = os.path.join(target_reference_dir, flat_name + '.html')
-        print("Rendering {} to {}... ".format(source_file_path, target_file_path), end='')
-        source_item = items_dict[flat_name]
-        with open(target_file_path, 'w') as target_file:
-            rendered = reference_template.render(item=source_item, today=datetime.datetime.now().ctime())
-            target_file.write(clean_html(rendered))
-            print_success('success!')
+        item = items_dict[flat_name]
+        images = image_state(item, source) if backend is not None else None
+        graph.record(item, template_paths, items_dict, built, prefetches.get(flat_name, []), images)
+    graph.save()
     return failures
  
-def build_reference_index(reference_dir, env):
-    import re
+def build_reference_index(items_dict, env):
     print('Building reference index')
     reference_items = list()
-    for filename in os.listdir(reference_dir):
-        if not filename.endswith('.xml'): continue
-        item = ReferenceItem(os.path.join(reference_dir,filename))
-        item.flatname = os.path.basename(filename)[:-4]
-        if any([re.search(pattern, item.flatname) for pattern in to_skip_patterns]):
-            print("skipping %s" % filename)
+    pages = published_reference_pages(items_dict)
+    for flat_name, item in sorted(items_dict.iteritems()):
+        if flat_name == '': continue # The alias for 'blank'
+        if flat_name not in pages:
+            print("skipping %s" % os.path.basename(item.source_xml))
             continue
         reference_items.append(item)
     categories = dict()
@@ -447,65 +2346,305 @@ def build_reference_index(reference_dir, env):
     elements.append({'type': 'end-category', 'content': None})
 
     index_template = env.get_template('reference_index_template.jinja')
-    with open(os.path.join('generated/reference', 'index.html'), 'w') as tfile:
-        tfile.write(clean_html(index_template.render(elements=elements)))
+    write_if_changed(os.path.join(target_reference_dir, 'index.html'),
+            clean_html(index_template.render(elements=elements)))
+    build_search_index(reference_items, env.globals['convert_hypertext'])
     print_success('success!')
 
-def build_tutorials(env):
+def search_key(name):
+    '''
+    What a name is looked up by in the search index: lowercased, and without
+    leading punctuation, so that '.keys()' is found by typing 'keys' and
+    '+ (addition)' by 'addition'. Mirrored in reference-search.js.
+    '''
+    key = re.sub(r'^[^a-z0-9]+', '', name.lower())
+    return key or name.lower()
+
+def search_shard(key):
+    '''The shard of the search index a key belongs to: its first letter, or '_' for anything else.'''
+    return key[0] if 'a' <= key[0] <= 'z' else '_'
+
+def summarize(html, length=120):
+    '''The first sentence of some HTML as plain text, cut short if it's long.'''
+    if not html.strip():
+        return ''
+    text = ' '.join(lxml.html.fragment_fromstring(html, create_parent='div').text_content().split())
+    m = re.match(r'.*?[.!?](?=\s|$)', text)
+    if m:
+        text = m.group(0)
+    if len(text) > length:
+        text = text[:length].rsplit(' ', 1)[0] + '...'
+    return text
+
+def search_index_shards(reference_items, convert_hypertext):
+    '''
+    The search index for the reference: a dictionary from shard name to a
+    list of entries sorted by search key, so that the entries matching a
+    prefix are next to each other. Each entry is a list of the search key,
+    name, flat name, category, subcategory, first line of syntax and a short
+    description.
+    '''
+    shards = {}
+    for item in reference_items:
+        name = item.name or item.flatname
+        syntax = ''
+        if item.syntax is not None:
+            lines = [line.strip() for line in ''.join(item.syntax.element().itertext()).splitlines()]
+            syntax = next((line for line in lines if line), '')
+        key = search_key(name)
+        shards.setdefault(search_shard(key), []).append([key, name, item.flatname,
+            item.category or '', item.subcategory or '', syntax, summarize(convert_hypertext(item.description))])
+    for entries in shards.itervalues():
+        entries.sort()
+    return shards
+
+def build_search_index(reference_items, convert_hypertext):
+    '''
+    Write the search index into generated/reference/search/, a JSON file per
+    shard, for the reference index page to load as the user types.
+    '''
+    search_dir = os.path.join(target_reference_dir, 'search')
+    if not os.path.exists(search_dir):
+        os.makedirs(search_dir)
+    shards = search_index_shards(reference_items, convert_hypertext)
+    for filename in os.listdir(search_dir):
+        if filename.endswith('.json') and filename[:-5] not in shards:
+            os.remove(os.path.join(search_dir, filename))
+    for shard, entries in shards.iteritems():
+        write_if_changed(os.path.join(search_dir, shard + '.json'), json.dumps(entries, separators=(',', ':')))
+
+class TutorialFingerprints(object):
+    '''
+    Records what each tutorial page (and, under the name '', the tutorial
+    index) was last built from: a fingerprint of the size and mtime of each of
+    its input files, and the display names of the reference pages it links
+    to. Kept between builds, so that tutorials whose inputs haven't changed
+    aren't built again.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.units = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.units = json.load(f)['units']
+
+    @staticmethod
+    def fingerprint(paths):
+        h = hashlib.sha1()
+        for path in paths:
+            stat = os.stat(path) if os.path.exists(path) else None
+            h.update('{}\0{}\0{}\n'.format(path, stat and stat.st_size, stat and stat.st_mtime))
+        return h.hexdigest()
+
+    def is_stale(self, unit, paths, target_file_path, items_dict):
+        if unit not in self.units or not os.path.exists(target_file_path):
+            return True
+        built = self.units[unit]
+        if built['fingerprint'] != self.fingerprint(paths):
+            return True
+        for name, display_name in built['names'].iteritems():
+            current = items_dict[name].name if name in items_dict else None
+            if current != display_name:
+                return True
+        return False
+
+    def record(self, unit, paths, linked_names, items_dict):
+        self.units[unit] = {
+            'fingerprint': self.fingerprint(paths),
+            'names': dict((name, items_dict[name].name if name in items_dict else None) for name in linked_names),
+        }
+
+    def prune(self, units):
+        for unit in list(self.units):
+            if unit not in units:
+                del self.units[unit]
+
+    def save(self):
+        write_json(self.path, {'units': self.units})
+
+def tutorial_inputs(folder):
+    '''Every file in a tutorial's folder: tutorial.xml, index.html, imgs/ and anything else.'''
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(os.path.join(tutorials_dir, folder)):
+        dirnames.sort()
+        paths.extend(os.path.normpath(os.path.join(dirpath, filename)) for filename in sorted(filenames))
+    return paths
+
+def render_tutorial_page(folder):
+    env = render_worker['env']
+    start = time.time()
+    tutorial = {'title': etree.parse(os.path.join(tutorials_dir, folder, 'tutorial.xml')).find('title').text}
+    # I want to use convert_hypertext on the examples so they can use things like 'ref';
+    # we can use lxml.html to parse the html into an element-tree!
+    # Note that even though the index.html files don't have <html> or <body> tags, lxml.html automatically creates nodes for them.
+    content = lxml.html.parse(os.path.join(tutorials_dir, folder, 'index.html'))
+    tutorial['content'] = content.getroot().find('body')
+    # Give images their size, so the page doesn't jump around as they load
+    for img in tutorial['content'].iter('img'):
+        src = img.get('src', '')
+        if img.get('width') or img.get('height') or re.match(r'^([a-z]+:|/)', src):
+            continue
+        path = os.path.join(tutorials_dir, folder, src)
+        size = image_size(path) if os.path.isfile(path) else None
+        if size:
+            img.set('width', str(size[0]))
+            img.set('height', str(size[1]))
+    parsed_time = time.time()
+    rendered = env.get_template('tutorial_item_template.jinja').render(tutorial=tutorial)
+    rendered_time = time.time()
+    cleaned = clean_html(rendered)
+    timings = {'parse': parsed_time - start, 'render': rendered_time - parsed_time, 'clean': time.time() - rendered_time}
+    write_if_changed(os.path.join(target_tutorials_dir, folder, 'index.html'), cleaned)
+    linked_names = sorted(set(ref_target(ref) for ref in tutorial['content'].iter('ref')))
+    return folder, timings, linked_names
+
+# Only the tutorials whose inputs have changed since they were last built
+# (see TutorialFingerprints) are built again, and likewise the index.
+def build_tutorials(env, assets, jobs=1):
     print('Building tutorials')
-    item_template = env.get_template('tutorial_item_template.jinja')
-    index_template = env.get_template('tutorial_index_template.jinja')
-    index_data = etree.parse(os.path.join(tutorials_dir, 'tutorials.xml'))
-    tutorials = []
-    for tutorial_element in index_data.iterfind('tutorial'):
-        tutorial = {}
-        tutorial['folder'] = tutorial_element.text
-        tutorial['url'] = canon_tutorials_dir + tutorial['folder']
-        print('Handling tutorial {}... '.format(tutorial['folder']), end='')
-        tutorial_data = etree.parse(os.path.join(tutorials_dir, tutorial['folder'], 'tutorial.xml'))
-        tutorial['image'] = os.path.join(tutorial['folder'], 'imgs', tutorial_data.find('image').text)
-        tutorial['title'] = tutorial_data.find('title').text
-        tutorial['author'] = tutorial_data.find('author').text
-        tutorial['blurb'] = tutorial_data.find('blurb')
-        # I want to use convert_hypertext on the examples so they can use things like 'ref';
-        # we can use lxml.html to parse the html into an element-tree!
-        # Note that even though the index.html files don't have <html> or <body> tags, lxml.html automatically creates nodes for them.
-        content = lxml.html.parse(os.path.join(tutorials_dir, tutorial['folder'], 'index.html'))
-        tutorial['content'] = content.getroot().find('body')
-        target_tutorial_dir = os.path.join(target_tutorials_dir, tutorial['folder'])
-        if not os.path.exists(target_tutorial_dir):
-            os.makedirs(target_tutorial_dir)
-        with open(os.path.join(target_tutorial_dir, 'index.html'), 'w') as target_file:
-            target_file.write(clean_html(item_template.render(tutorial=tutorial)))
-        target_img_dir = os.path.join(target_tutorial_dir, 'imgs')
-        if os.path.exists(target_img_dir):
-            shutil.rmtree(target_img_dir)
-        shutil.copytree(os.path.join(tutorials_dir, tutorial['folder'], 'imgs'), target_img_dir)
-        tutorials.append(tutorial)
+    items_dict = env.globals['items_dict']
+    fingerprints = TutorialFingerprints(os.path.join(cache_dir, 'tutorial-fingerprints.json'))
+    folders = tutorial_folders()
+    item_templates = template_files(env, 'tutorial_item_template.jinja')
+    inputs = {}
+    stale = []
+    for folder in folders:
+        inputs[folder] = tutorial_inputs(folder) + item_templates
+        target_tutorial_dir = os.path.join(target_tutorials_dir, folder)
+        if fingerprints.is_stale(folder, inputs[folder], os.path.join(target_tutorial_dir, 'index.html'), items_dict):
+            stale.append(folder)
+            if not os.path.exists(target_tutorial_dir):
+                os.makedirs(target_tutorial_dir)
+        else:
+            assets.keep(os.path.join(target_tutorial_dir, 'imgs'))
+    # The pages themselves are rendered by render_tutorial_page, possibly in
+    # other processes.
+    for folder, timings, linked_names in render_pages(render_tutorial_page, stale, env, jobs):
+        build_profile.page('tutorials/' + folder, timings)
+        print('Handling tutorial {}... '.format(folder), end='')
+        assets.sync(os.path.join(tutorials_dir, folder, 'imgs'),
+                os.path.join(target_tutorials_dir, folder, 'imgs'))
+        fingerprints.record(folder, inputs[folder], linked_names, items_dict)
         print_success('success!')
-    print('Building tutorial index page... ', end='')
-    with open(os.path.join(target_tutorials_dir, 'index.html'), 'w') as target_file:
-        target_file.write(clean_html(index_template.render(tutorials=tutorials)))
-    print_success('success!')
+    if len(stale) < len(folders):
+        print('{} tutorial(s) unchanged.'.format(len(folders) - len(stale)))
+
+    index_inputs = ([os.path.join(tutorials_dir, 'tutorials.xml')] +
+            [os.path.join(tutorials_dir, folder, 'tutorial.xml') for folder in folders] +
+            template_files(env, 'tutorial_index_template.jinja'))
+    index_path = os.path.join(target_tutorials_dir, 'index.html')
+    if fingerprints.is_stale('', index_inputs, index_path, items_dict):
+        print('Building tutorial index page... ', end='')
+        index_template = env.get_template('tutorial_index_template.jinja')
+        tutorials = []
+        for folder in folders:
+            tutorial = {}
+            tutorial['folder'] = folder
+            tutorial['url'] = canon_tutorials_dir + tutorial['folder']
+            tutorial_data = etree.parse(os.path.join(tutorials_dir, tutorial['folder'], 'tutorial.xml'))
+            tutorial['image'] = os.path.join(tutorial['folder'], 'imgs', tutorial_data.find('image').text)
+            tutorial['title'] = tutorial_data.find('title').text
+            tutorial['author'] = tutorial_data.find('author').text
+            tutorial['blurb'] = tutorial_data.find('blurb')
+            tutorials.append(tutorial)
+        write_if_changed(index_path, clean_html(index_template.render(tutorials=tutorials)))
+        linked_names = set(ref_target(ref) for tutorial in tutorials if tutorial['blurb'] is not None
+                for ref in tutorial['blurb'].iter('ref'))
+        fingerprints.record('', index_inputs, linked_names, items_dict)
+        print_success('success!')
+    else:
+        print('Tutorial index unchanged.')
+    fingerprints.prune(set(folders) | set(['']))
+    fingerprints.save()
 
 def build_examples(env):
     print("building examples")
     if not os.path.exists(target_examples_dir):
         os.makedirs(target_examples_dir)
     examples_template = env.get_template('examples_index.jinja')
-    with open(os.path.join(target_examples_dir, 'index.html'), 'w') as tfile:
-        tfile.write(clean_html(examples_template.render()))
+    write_if_changed(os.path.join(target_examples_dir, 'index.html'), clean_html(examples_template.render()))
     print_success('success!')
 
 def build_cover(env):
     print("building index.html")
     cover_template = env.get_template('index.jinja')
-    with open(os.path.join('generated', 'index.html'), 'w') as tfile:
-        tfile.write(clean_html(cover_template.render()))
+    write_if_changed(os.path.join(target_cover_dir, 'index.html'), clean_html(cover_template.render()))
     print_success('success!')
 
-def build(build_images, to_update):
+sitemap_namespace = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+class Sitemap(object):
+    '''
+    generated/sitemap.xml, which lists the site's pages, each with the date
+    it last changed. A page's lastmod only moves when its content does: the
+    SHA-1 of each page is kept in the cache with its lastmod, along with the
+    size and mtime the hash was computed for, so only pages that have been
+    written again are read.
+    '''
+    def __init__(self, path):
+        self.path = path
+        # Path on the site -> [size, mtime, sha1, lastmod]
+        self.pages = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.pages = json.load(f)['pages']
+
+    def update(self, urls, today):
+        '''
+        Hash the pages at urls (paths on the site), giving those that are new
+        or have changed a lastmod of today. Returns how many that was.
+        '''
+        pages = {}
+        changed = 0
+        for url in urls:
+            path = os.path.join(target_dir, url.lstrip('/'))
+            if url.endswith('/'):
+                path = os.path.join(path, 'index.html')
+            if not os.path.exists(path):
+                continue
+            entry = self.pages.get(url)
+            digest = file_digest(path, entry)
+            if entry and entry[2] == digest[2]:
+                pages[url] = digest + entry[3:]
+            else:
+                pages[url] = digest + [today]
+                changed += 1
+        self.pages = pages
+        return changed
+
+    def write(self, path):
+        urlset = etree.Element('{%s}urlset' % sitemap_namespace, nsmap={None: sitemap_namespace})
+        for url, entry in sorted(self.pages.iteritems()):
+            element = etree.SubElement(urlset, '{%s}url' % sitemap_namespace)
+            etree.SubElement(element, '{%s}loc' % sitemap_namespace).text = site_url + url
+            etree.SubElement(element, '{%s}lastmod' % sitemap_namespace).text = entry[3]
+        return write_if_changed(path, etree.tostring(urlset, encoding='UTF-8', xml_declaration=True,
+                pretty_print=True))
+
+    def save(self):
+        write_json(self.path, {'pages': self.pages})
+
+def build_sitemap(items_dict):
+    '''Write generated/sitemap.xml, listing the cover, the examples, the reference and the tutorials.'''
+    print('Building sitemap... ', end='')
+    urls = [canon_cover_dir, canon_examples_dir, canon_reference_dir, canon_tutorials_dir]
+    urls += [create_ref_link(flat_name) for flat_name in published_reference_pages(items_dict)]
+    urls += [canon_tutorials_dir + folder + '/' for folder in tutorial_folders()]
+    sitemap = Sitemap(os.path.join(cache_dir, 'sitemap.json'))
+    changed = sitemap.update(urls, build_date())
+    sitemap.write(os.path.join(target_dir, 'sitemap.xml'))
+    sitemap.save()
+    print_success('{} page(s), {} changed.'.format(len(sitemap.pages), changed))
+
+# to_update is a list of flat names to build, or None to build whichever pages
+# are out of date.
+# With profile set to a path, a report of where the time went is written
+# there (and summarized, listing the profile_top slowest pages and examples).
+def build(build_images, to_update, jobs=1, render_server=None, profile=None, profile_top=10,
+        optimize=False, compress=False, image_timeout=default_image_timeout, render_backend='jython',
+        timestamp=False):
     print_header("Building content")
+    build_profile.reset()
 
     reference_dir = os.path.join(src_dir, 'Reference', 'api_en')
     tutorials_dir = os.path.join(src_dir, 'Tutorials')
@@ -521,23 +2660,236 @@ def build(build_images, to_update):
         print_error("Can't find {}; please don't change the format of the repo on me.".format(reference_dir))
         sys.exit(1)
 
-    env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir), trim_blocks='true')
-    
-    failures += build_reference(reference_dir, to_update, env, build_images)
-    build_tutorials(env)
-    build_reference_index(reference_dir, env)
-    build_cover(env)
-    build_examples(env)
-       
+    # Parsed once, and shared by everything that needs the reference
+    with build_profile.phase('parse reference'):
+        items_dict = load_reference_items(reference_dir)
+    backend = None
+    if build_images:
+        backend = make_render_backend(render_backend, jobs, render_server, image_timeout)
+    with build_profile.phase('find stale pages'):
+        if to_update is None:
+            to_update = find_stale_pages(items_dict, backend)
+    with build_profile.phase('check links'):
+        report_links(items_dict)
+    env = make_environment(template_dir, items_dict)
+    assets = asset_sync()
+
+    # build_reference times its own phases, images and rendering
+    failures += build_reference(items_dict, to_update, env, backend, jobs, build_timestamp(timestamp))
+    removed = remove_unpublished_pages(items_dict)
+    if removed:
+        print('Removed {} page(s) that are no longer published.'.format(removed))
+    with build_profile.phase('build tutorials'):
+        build_tutorials(env, assets, jobs)
+    with build_profile.phase('build reference index'):
+        build_reference_index(items_dict, env)
+    with build_profile.phase('build cover and examples'):
+        build_cover(env)
+        build_examples(env)
+    with build_profile.phase('build sitemap'):
+        build_sitemap(items_dict)
+
     print('Copying static resources...')
-    distutils.dir_util.copy_tree('./content', target_dir)
-    print('Done.')
+    with build_profile.phase('copy static resources'):
+        copied, removed = assets.sync(content_dir, target_dir)
+        removed += assets.prune()
+        assets.save()
+    print('Done ({} file(s) copied, {} removed).'.format(copied, removed))
+    if optimize:
+        with build_profile.phase('optimize images'):
+            optimize_images(jobs)
+    if compress:
+        with build_profile.phase('compress outputs'):
+            compress_outputs(jobs)
+    elif os.path.exists(os.path.join(target_dir, 'manifest.json')):
+        with build_profile.phase('refresh manifest'):
+            refresh_manifest()
     timedelta = datetime.datetime.now() - start
     print('Build took {} seconds'.format(timedelta.seconds + timedelta.microseconds/1000000))
+    if profile:
+        build_profile.save(profile)
+        build_profile.print_summary(profile_top)
+        print('Profile written to {}'.format(profile))
     if failures:
         print_error('{} failure(s)'.format(failures))
         sys.exit(1)
 
+class RenderServer(object):
+    '''
+    Keeps a single generate_images.py process (and so a single warmed-up JVM)
+    running, and feeds it batches of workitems. Batches are rendered one at a
+    time, in the order they arrive. An example that runs for longer than
+    timeout seconds, or whose process dies under it, is reported as failed
+    and the process restarted for the rest of the batch.
+    '''
+    def __init__(self, base_cmd, timeout=default_image_timeout):
+        self.base_cmd = base_cmd
+        self.timeout = timeout
+        self.process = None
+        self.lock = threading.Lock()
+        self.out = None
+
+    def ensure_running(self):
+        if self.process is None or self.process.poll() is not None:
+            print('Starting image process...')
+            # close_fds, so that it doesn't hold open a local_render_worker's
+            # pipe and keep it from seeing the batch end.
+            self.process = subprocess.Popen(self.base_cmd, stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, close_fds=True)
+
+    def send(self, line):
+        '''Pass a line on to the client, if it's still there.'''
+        if self.out is not None:
+            try:
+                self.out.write(line)
+                self.out.flush()
+            except (socket.error, IOError):
+                # The client went away; keep draining the batch so the
+                # next one starts in step.
+                self.out = None
+
+    def render(self, specs, out):
+        '''Render the workitems in specs, relaying the image process's output to out.'''
+        with self.lock:
+            self.out = out
+            pending = [(json.loads(spec)['name'], spec) for spec in specs]
+            while pending:
+                finished, current, expired = self.run_batch(pending)
+                if finished is None:
+                    break
+                if current is None:
+                    # No example to blame, so the client fails whatever is left.
+                    print_error('Image process died; it will be restarted for the next batch.')
+                    break
+                if expired:
+                    print_error('Image process killed after {} ran for more than {:g} seconds.'.format(
+                        current, self.timeout))
+                    result = {'error': 'timed out after {:g} seconds'.format(self.timeout), 'seconds': self.timeout}
+                else:
+                    print_error('Image process died running {}.'.format(current))
+                    result = {'error': 'image process exited with status {}'.format(self.process.returncode)}
+                result.update(event='result', name=current, status='failure')
+                self.send(event_prefix + json.dumps(result) + '\n')
+                pending = [(name, spec) for name, spec in pending if name not in finished and name != current]
+            self.out = None
+
+    def run_batch(self, pending):
+        '''
+        Send the (name, spec) pairs in pending to the image process, relaying
+        its output. Returns (None, None, False) if the batch finished;
+        otherwise, the names of the examples that did, the one that was
+        running when the process stopped, and whether it was killed for
+        taking too long.
+        '''
+        self.ensure_running()
+        process = self.process
+        # Feed the batch from another thread, as image_worker does.
+        def feed():
+            try:
+                process.stdin.write(''.join(spec + '\n' for name, spec in pending) + '\n')
+                process.stdin.flush()
+            except IOError: # The process died; its output ends too
+                pass
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        watchdog = Watchdog(self.timeout, process.kill)
+        finished = set()
+        current = None
+        try:
+            for line in iter(process.stdout.readline, ''):
+                message = parse_event(line)
+                if message is not None:
+                    if message['event'] == 'done':
+                        return None, None, False
+                    elif message['event'] == 'running':
+                        current = message['name']
+                        watchdog.running(current)
+                    elif message['event'] == 'result':
+                        current = None
+                        watchdog.finished()
+                        finished.add(message['name'])
+                self.send(line)
+            process.wait()
+        finally:
+            watchdog.stop()
+            feeder.join()
+        return finished, current, watchdog.expired is not None
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+class RenderRequestHandler(SocketServer.StreamRequestHandler):
+    '''Reads one batch of workitems (ended by a blank line) and streams back the results.'''
+    def handle(self):
+        specs = []
+        for line in iter(self.rfile.readline, ''):
+            line = line.rstrip('\n')
+            if not line:
+                break
+            specs.append(line)
+        if not specs:
+            return # Just checking whether we're here (see RenderUnixServer.server_bind)
+        print('Rendering {} example(s)...'.format(len(specs)))
+        start = time.time()
+        self.server.renderer.render(specs, self.wfile)
+        print_success('Done in {:.2f} seconds.'.format(time.time() - start))
+
+class RenderUnixServer(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+    bound = False
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.server_address)
+            except socket.error:
+                # Left behind by a server that didn't shut down cleanly.
+                os.remove(self.server_address)
+            else:
+                raise socket.error('a render server is already listening there')
+            finally:
+                probe.close()
+        # Nobody but us gets to connect, not even between bind and chmod.
+        umask = os.umask(0o177)
+        try:
+            SocketServer.ThreadingUnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0o600)
+        self.bound = True
+
+    def server_close(self):
+        SocketServer.ThreadingUnixStreamServer.server_close(self)
+        if self.bound and os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+def serve_renderer(path, javabin="java", image_timeout=default_image_timeout):
+    print_header("Serving renderer")
+    renderer = RenderServer(image_process_cmd(src_dir, "./processing-py.jar", javabin), image_timeout)
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    try:
+        server = RenderUnixServer(path, RenderRequestHandler)
+    except socket.error as e:
+        print_error("Can't listen on {}: {}".format(path, e))
+        sys.exit(1)
+    server.renderer = renderer
+    renderer.ensure_running()
+    if path == render_server_socket:
+        print("Listening on {}; build with --render-server to use it.".format(path))
+    else:
+        print("Listening on {}; build with --render-server {} to use it.".format(path, path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        renderer.stop()
+
 def test():
     print_header("Testing")
     import random, SimpleHTTPServer, SocketServer, webbrowser
@@ -549,6 +2901,203 @@ def test():
     webbrowser.open(address)
     httpd.serve_forever()
 
+# Polled by every page that `watch` serves; it reloads the page when the
+# server's count of rebuilds moves past the one it was served with.
+live_reload_script = '''<script>
+(function poll(generation) {
+    var request = new XMLHttpRequest();
+    request.open('GET', '/__reload?since=' + generation);
+    request.onload = function() {
+        if (request.responseText != String(generation)) {
+            location.reload();
+        } else {
+            poll(generation);
+        }
+    };
+    request.onerror = function() { setTimeout(function() { poll(generation); }, 1000); };
+    request.send();
+})(%d);
+</script>
+'''
+
+class LiveReload(object):
+    '''Counts the rebuilds done by `watch`, and lets requests wait for the next one.'''
+    def __init__(self):
+        self.generation = 0
+        self.condition = threading.Condition()
+
+    def bump(self):
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def wait(self, since, timeout):
+        '''Wait for a rebuild after generation since (or for timeout seconds), returning the current generation.'''
+        with self.condition:
+            if self.generation == since:
+                self.condition.wait(timeout)
+            return self.generation
+
+class WatchRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    '''Serves generated/, with the live reload script added to every page.'''
+    def translate_path(self, path):
+        path = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self, path)
+        return os.path.join(os.path.abspath(target_dir), os.path.relpath(path, os.getcwd()))
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == '/__reload':
+            since = int(urlparse.parse_qs(url.query).get('since', ['0'])[0])
+            self.send_text(str(self.server.live_reload.wait(since, 25)), 'text/plain')
+            return
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and url.path.endswith('/'):
+            path = os.path.join(path, 'index.html')
+        if not path.endswith('.html') or not os.path.isfile(path):
+            SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+            return
+        # Read the generation first, so that a rebuild finishing while the
+        # page is being read still triggers a reload.
+        script = live_reload_script % self.server.live_reload.generation
+        with open(path) as f:
+            page = f.read()
+        if '</body>' in page:
+            page = page.replace('</body>', script + '</body>', 1)
+        else:
+            page += script
+        self.send_text(page, 'text/html')
+
+    def send_text(self, text, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(text)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        pass # The console is for rebuilds
+
+class WatchTCPServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+def snapshot(root):
+    '''The (mtime, size) of every file under root, skipping hidden files and editor backups.'''
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for filename in filenames:
+            if filename.startswith('.') or filename.endswith('~'):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+            except OSError: # Deleted since we listed it
+                continue
+            files[path] = (stat.st_mtime, stat.st_size)
+    return files
+
+class SiteWatcher(object):
+    '''
+    Keeps everything a build sets up (the parsed reference, the template
+    environment, the asset manifest, and the backend's image process) in
+    memory, and rebuilds just the outputs that depend on what has changed.
+    '''
+    def __init__(self, backend=None):
+        self.backend = backend
+        if backend is not None:
+            backend.keep_running()
+        self.roots = {
+            'reference': reference_dir,
+            'tutorials': tutorials_dir,
+            'templates': os.path.join(src_dir, 'template'),
+            'content': os.path.join(src_dir, 'content'),
+        }
+        self.snapshots = {}
+        self.items_dict = {}
+        # Templates are edited as we watch, so check them every time they're used.
+        self.env = make_environment(self.roots['templates'], self.items_dict, auto_reload=True)
+        self.assets = asset_sync()
+
+    def changes(self):
+        '''The names of the roots whose files have changed since the last call.'''
+        changed = set()
+        for name, root in self.roots.iteritems():
+            files = snapshot(root)
+            if files != self.snapshots.get(name):
+                changed.add(name)
+            self.snapshots[name] = files
+        return changed
+
+    def rebuild(self, changed):
+        # Whatever changed (a page name, a tutorial), elements must be converted afresh.
+        self.env.globals['convert_hypertext'].forget()
+        if 'reference' in changed:
+            items_dict = load_reference_items(reference_dir)
+            # The environment holds on to this dictionary, so update it in place.
+            self.items_dict.clear()
+            self.items_dict.update(items_dict)
+            remove_unpublished_pages(self.items_dict)
+        if changed & set(['reference', 'templates']):
+            stale = find_stale_pages(self.items_dict, self.backend)
+            failures = build_reference(self.items_dict, stale, self.env, self.backend, today=build_timestamp())
+            if failures:
+                print_error('{} failure(s)'.format(failures))
+            build_reference_index(self.items_dict, self.env)
+        if changed & set(['reference', 'tutorials', 'templates']):
+            # Only the tutorials that are affected are built again.
+            build_tutorials(self.env, self.assets)
+        if changed & set(['reference', 'tutorials']):
+            report_links(self.items_dict)
+        if 'templates' in changed:
+            build_cover(self.env)
+            build_examples(self.env)
+        if 'content' in changed:
+            copied, removed = self.assets.sync(self.roots['content'], target_dir)
+            print('Static resources: {} file(s) copied, {} removed.'.format(copied, removed))
+        self.assets.save()
+
+def watch(port, interval=0.25, backend=None):
+    '''
+    Build the site, then rebuild whatever is affected by each change to its
+    sources, serving it as we go. Examples are run with backend, if it isn't None.
+    '''
+    print_header("Watching")
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    watcher = SiteWatcher(backend)
+    live_reload = LiveReload()
+    server = WatchTCPServer(("localhost", port), WatchRequestHandler)
+    server.live_reload = live_reload
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            changed = watcher.changes()
+            if changed:
+                print_header('Rebuilding ({})'.format(', '.join(sorted(changed))))
+                start = time.time()
+                try:
+                    watcher.rebuild(changed)
+                except Exception:
+                    # Most likely a half-written file; the next save will try again.
+                    print_error(traceback.format_exc())
+                    print_error('Rebuild failed.')
+                else:
+                    print_success('Rebuilt in {:.2f} seconds.'.format(time.time() - start))
+                    live_reload.bump()
+                print('Serving on http://localhost:{}/ (Ctrl-C to stop)'.format(port))
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        if backend is not None:
+            backend.stop()
+
 # A flat name is the name of the file, sans .xml
 def get_flat_names_to_update(all_, random, files):
 
@@ -562,23 +3111,12 @@ def get_flat_names_to_update(all_, random, files):
         return [map(lambda f: f[:-4], filter(lambda f: f.endswith('.xml'), os.listdir(reference_dir)))[0]]
 
     if not all_:
-        def should_be_updated(f):
-            src_f = os.path.join(reference_dir, f)
-            if not f.endswith('.xml'):
-                return False
-            target_f = os.path.join(target_dir, f[:-4] + '.html')
-            if not os.path.exists(target_f):
-                return True
-            return os.path.getmtime(src_f) > os.path.getmtime(target_f)
-        
-        files = filter(should_be_updated, os.listdir(reference_dir))
-    else:
-        files = filter(lambda f: f.endswith('.xml'), os.listdir(reference_dir))
+        # Working out which pages are stale needs the parsed reference, so
+        # leave it to build().
+        return None
 
-    # skip files that match patterns in to_skip_patterns
-    files = [f for f in files if not(any([re.search(patt, f) for patt in to_skip_patterns]))]
-    files = map(lambda f: f[:-4], files)
-    return files
+    files = filter(lambda f: f.endswith('.xml'), os.listdir(reference_dir))
+    return sorted(published_reference_pages(f[:-4] for f in files))
 
 if __name__ == '__main__':
     class DefaultHelpParser(ArgumentParser):
@@ -596,7 +3134,52 @@ if __name__ == '__main__':
     build_type.add_argument('--random', action='store_true', help='Build an arbitrary file (for testing purposes)')
     build_type.add_argument('--files', nargs='+', help='Build a specific set of files')
     build_parser.add_argument('--images', action='store_true', help="Run and save example sketches")
+    build_parser.add_argument('--jobs', type=int, default=1, help="Number of image processes (and page-rendering processes) to run at once")
+    build_parser.add_argument('--render-server', nargs='?', const=render_server_socket, metavar='SOCKET',
+            help="Send example sketches to a running serve-renderer instead of starting a JVM (default socket: .build-cache/render-server.sock)")
+    build_parser.add_argument('--optimize-images', action='store_true',
+            help="Losslessly recompress example and tutorial images (with optipng and jpegtran, if installed)")
+    build_parser.add_argument('--compress', action='store_true',
+            help="Write .gz (and .br, with the brotli module) copies of text files, and generated/manifest.json")
+    build_parser.add_argument('--render-backend', choices=render_backends, default='jython',
+            help="How to make example images: run them in Processing.py (jython), use only cached images (cache-only), or write placeholders (stub)")
+    build_parser.add_argument('--image-timeout', type=float, default=default_image_timeout, metavar='SECONDS',
+            help="Stop an example sketch that runs for longer than this, and count it as failed (0 to never stop one)")
+    build_parser.add_argument('--timestamp', action='store_true',
+            help="Say when each reference page was built on the page (SOURCE_DATE_EPOCH, if set, does this too)")
+    build_parser.add_argument('--profile', nargs='?', const=os.path.join(cache_dir, 'profile.json'), metavar='FILE',
+            help="Time each phase, page and example, and write a JSON report to FILE (default: .build-cache/profile.json)")
+    build_parser.add_argument('--profile-top', type=int, default=10, metavar='N',
+            help="Number of slowest pages and examples to list with --profile")
     test_parser = subparsers.add_parser('test', description='Test locally')
+    serve_renderer_parser = subparsers.add_parser('serve-renderer',
+            description='Keep an image process running for use by builds with --render-server')
+    serve_renderer_parser.add_argument('--socket', default=render_server_socket,
+            help="Unix domain socket to listen on (default: .build-cache/render-server.sock)")
+    serve_renderer_parser.add_argument('--image-timeout', type=float, default=default_image_timeout, metavar='SECONDS',
+            help="Stop an example sketch that runs for longer than this, and count it as failed (0 to never stop one)")
+    watch_parser = subparsers.add_parser('watch',
+            description='Serve the site locally, rebuilding what changes as you edit it')
+    watch_parser.add_argument('--port', type=int, default=8000, help="Port to serve the site on")
+    watch_parser.add_argument('--interval', type=float, default=0.25, help="Seconds between checks for changes")
+    watch_parser.add_argument('--images', action='store_true', help="Run the example sketches of changed pages")
+    watch_parser.add_argument('--render-server', nargs='?', const=render_server_socket, metavar='SOCKET',
+            help="Send example sketches to a running serve-renderer instead of starting a JVM (default socket: .build-cache/render-server.sock)")
+    watch_parser.add_argument('--render-backend', choices=render_backends, default='jython',
+            help="How to make example images: run them in Processing.py (jython), use only cached images (cache-only), or write placeholders (stub)")
+    watch_parser.add_argument('--image-timeout', type=float, default=default_image_timeout, metavar='SECONDS',
+            help="Stop an example sketch that runs for longer than this, and count it as failed (0 to never stop one)")
+    check_examples_parser = subparsers.add_parser('check-examples',
+            description="Run the reference's example sketches without saving images, failing if any fail")
+    check_examples_parser.add_argument('--jobs', type=int, default=1, help="Number of image processes to run at once")
+    check_examples_parser.add_argument('--render-server', nargs='?', const=render_server_socket, metavar='SOCKET',
+            help="Send example sketches to a running serve-renderer instead of starting a JVM (default socket: .build-cache/render-server.sock)")
+    check_examples_parser.add_argument('--image-timeout', type=float, default=default_image_timeout, metavar='SECONDS',
+            help="Stop an example sketch that runs for longer than this, and count it as failed (0 to never stop one)")
+    check_examples_parser.add_argument('--junit', default=os.path.join(cache_dir, 'example-checks.xml'), metavar='FILE',
+            help="Where to write the JUnit-style report (default: .build-cache/example-checks.xml)")
+    check_links_parser = subparsers.add_parser('check-links',
+            description='Report links between pages that lead nowhere, failing if there are any')
     clean_parser = subparsers.add_parser('clean', description='Clean generated stuff')
     args = parser.parse_args()
 
@@ -608,8 +3191,27 @@ if __name__ == '__main__':
     depends_dir = os.path.realpath('./depends')
 
     if args.command == 'build':
-        build(build_images=args.images, to_update=get_flat_names_to_update(all_=args.all, random=args.random, files=args.files))
+        build(build_images=args.images, to_update=get_flat_names_to_update(all_=args.all, random=args.random, files=args.files),
+                jobs=args.jobs, render_server=args.render_server, profile=args.profile, profile_top=args.profile_top,
+                optimize=args.optimize_images, compress=args.compress, image_timeout=args.image_timeout,
+                render_backend=args.render_backend, timestamp=args.timestamp)
+    elif args.command == 'serve-renderer':
+        serve_renderer(args.socket, image_timeout=args.image_timeout)
     elif args.command == 'test':
         test()
+    elif args.command == 'watch':
+        backend = None
+        if args.images:
+            backend = make_render_backend(args.render_backend, render_server=args.render_server,
+                    timeout=args.image_timeout)
+        watch(args.port, args.interval, backend)
+    elif args.command == 'check-examples':
+        if check_examples(args.junit, args.jobs, args.render_server, args.image_timeout):
+            sys.exit(1)
+    elif args.command == 'check-links':
+        if report_links(load_reference_items(reference_dir)):
+            sys.exit(1)
     elif args.command == 'clean':
         shutil.rmtree(target_dir)
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
@@ -1,8 +1,9 @@
 from __future__ import division, print_function
 import sys
 import os
-import argparse
-import re
+import json
+import struct
+import time
 import traceback
 
 import jarray
@@ -22,14 +23,23 @@ def debug_error():
     for line in traceback.format_exc().splitlines()[0:10]:
         debug_problem(line)
 
-def output_running(workitem):
-    print(':RUNNING:{}'.format(workitem['name']))
+# Messages for generator.py are single lines of JSON after this prefix, so
+# they can be told apart from whatever the sketches print. They're flushed
+# right away; generator.py is waiting on them while we wait for more work.
+event_prefix = ':EVENT:'
 
-def output_success(workitem):
-    print(':SUCCESS:')
+def output_event(event, **fields):
+    fields['event'] = event
+    print(event_prefix + json.dumps(fields))
+    sys.stdout.flush()
 
-def output_failure(workitem):
-    print(':FAILURE:')
+def png_size(path):
+    '''The (width, height) of a PNG, or None if it isn't one.'''
+    with open(path, 'rb') as f:
+        header = f.read(24)
+    if len(header) < 24 or header[12:16] != 'IHDR':
+        return None
+    return struct.unpack('>II', header[16:24])
 
 try:
     import jycessing.Runner, jycessing.RunnableSketch, jycessing.StreamPrinter
@@ -38,6 +48,8 @@ except:
     debug_problem("Note: don't run this file directly; just use generator.py.")
     sys.exit(1) 
 
+# The sketch's code comes from the workitem; its scriptfile names a file in a
+# directory that generator.py provides for it, but is never written.
 class ExampleImageGenSketch(jycessing.RunnableSketch):
     def __init__(self, workitem):
         self.scriptfile = workitem['scriptfile']
@@ -78,36 +90,49 @@ class ExampleImageGenSketch(jycessing.RunnableSketch):
     def shouldRun(self):
         return 1
 
-def gen(workitems):
-    for workitem in workitems:
-        output_running(workitem)
-        try:
-            with open(workitem['scriptfile']) as f:
-                workitem['code'] = f.read()
-            sketch = ExampleImageGenSketch(workitem)
-            sketch.gen_image()
-            output_success(workitem)
-        except jycessing.PythonSketchError, e:
-            if "NullPointerException" in e.getMessage():
-                debug_problem("NullPointerException - {} is probably dynamic-mode; fix that, please.".format(workitem['name']))
-            else:
-                debug_error()
-            output_failure(workitem)
-        except:
+def gen(workitem):
+    '''Run a workitem's sketch, reporting how it went (and how long it took) in a result event.'''
+    output_event('running', name=workitem['name'])
+    result = {'name': workitem['name'], 'status': 'failure'}
+    start = time.time()
+    try:
+        sketch = ExampleImageGenSketch(workitem)
+        sketch.gen_image()
+        result['status'] = 'success'
+    except jycessing.PythonSketchError, e:
+        if "NullPointerException" in e.getMessage():
+            debug_problem("NullPointerException - {} is probably dynamic-mode; fix that, please.".format(workitem['name']))
+        else:
             debug_error()
-            output_failure(workitem)
+        result['error'] = e.getMessage()
+    except:
+        debug_error()
+        result['error'] = traceback.format_exc().splitlines()[-1]
+    result['seconds'] = time.time() - start
+    if result['status'] == 'success' and os.path.exists(workitem['imagefile']):
+        result['bytes'] = os.path.getsize(workitem['imagefile'])
+        size = png_size(workitem['imagefile'])
+        if size:
+            result['width'], result['height'] = size
+    output_event('result', **result)
+
+def serve():
+    '''
+    Render workitems read from stdin, one JSON object per line, until stdin is
+    closed. A blank line ends a batch; we answer it with a done event so that
+    generator.py knows everything it sent has been handled.
+    '''
+    for line in iter(sys.stdin.readline, ''):
+        line = line.strip()
+        if not line:
+            output_event('done')
+            continue
+        gen(json.loads(line))
 
 if __name__ == '__main__':
     debug('Image process started.')
-    parser = argparse.ArgumentParser(description='Build a set of images.') 
-    parser.add_argument('--todo', nargs='+', type=str)
-    args = parser.parse_args()
     try:
-        workitems = []
-        for obj in args.todo:
-            name, scriptfile, imagefile = obj.split(':')
-            workitems.append({'name':name, 'scriptfile':scriptfile, 'imagefile':imagefile})
-        gen(workitems)
+        serve()
     except:
         debug_error()
         sys.exit(1)